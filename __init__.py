@@ -5,22 +5,31 @@ from trytond.pool import Pool
 from . import account
 from . import payment
 from . import party
+from . import ir
 
 
 def register():
     Pool.register(
         account.PaymentType,
+        account.Company,
         account.BankAccount,
+        account.BankAccountOwnerViolation,
         account.Party,
         account.Invoice,
+        account.Account,
+        account.Move,
         account.Line,
+        account.LineOpenBalance,
         account.CompensationMoveStart,
+        account.CompensationMoveBatchStart,
         payment.Journal,
         payment.Group,
         payment.Payment,
+        ir.Cron,
         module='account_bank', type_='model')
     Pool.register(
         payment.PayLine,
         account.CompensationMove,
+        account.CompensationMoveBatch,
         party.PartyReplace,
         module='account_bank', type_='wizard')
@@ -1,12 +1,23 @@
 # This file is part of account_bank module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from sql import Null
-from sql.aggregate import BoolOr
-from sql.operators import In
+from sql import Conflict, For, Literal, Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Equal, Exists
+import warnings
+from collections import defaultdict
+from weakref import WeakKeyDictionary
 from decimal import Decimal
-
-from trytond.model import ModelView, fields
+from itertools import chain, groupby
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import (
+    Exclude, Index, ModelSQL, ModelView, Unique, dualmethod, fields)
+from trytond.tools import grouped_slice, sqlite_apply_types
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, If
 from trytond.transaction import Transaction
@@ -14,6 +25,8 @@ from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 
+from .instrumentation import instrumented
+
 ACCOUNT_BANK_KIND = [
     ('none', 'None'),
     ('party', 'Party'),
@@ -46,6 +59,8 @@ class PaymentType(metaclass=PoolMeta):
             'required': Eval('account_bank') == 'other',
             'invisible': Eval('account_bank') != 'other',
             })
+    _account_bank_from_cache = Cache(
+        __name__ + '.account_bank_from', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -57,6 +72,51 @@ class PaymentType(metaclass=PoolMeta):
     def default_account_bank():
         return 'none'
 
+    @classmethod
+    def on_modification(cls, mode, payment_types, field_names=None):
+        super().on_modification(mode, payment_types, field_names=field_names)
+        cls._account_bank_from_cache.clear()
+
+    @classmethod
+    def get_account_bank_from(cls, payment_type_id, party_id, company_id):
+        '''
+        Returns the id of the party that owns the bank accounts of the payment
+        type for the party and the company.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        # Only party payment types depend on the party
+        key = (payment_type_id, company_id)
+        value = cls._account_bank_from_cache.get(key)
+        if value is None:
+            payment_type = cls(payment_type_id)
+            account_bank = payment_type.account_bank
+            owner_id = None
+            if account_bank == 'company':
+                if company_id is not None and company_id >= 0:
+                    owner_id = Company(company_id).party.id
+            elif account_bank == 'other':
+                if payment_type.party:
+                    owner_id = payment_type.party.id
+            value = (account_bank, owner_id)
+            cls._account_bank_from_cache.set(key, value)
+        account_bank, owner_id = value
+        if account_bank == 'party':
+            return party_id
+        return owner_id
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+
+    @classmethod
+    def on_modification(cls, mode, companies, field_names=None):
+        pool = Pool()
+        PaymentType = pool.get('account.payment.type')
+        super().on_modification(mode, companies, field_names=field_names)
+        PaymentType._account_bank_from_cache.clear()
+
 
 class BankAccount(metaclass=PoolMeta):
     __name__ = 'bank.account'
@@ -71,6 +131,7 @@ class BankAccount(metaclass=PoolMeta):
                 ])
 
     @classmethod
+    @instrumented
     def write(cls, *args):
         actions = iter(args)
         all_accounts = []
@@ -78,64 +139,225 @@ class BankAccount(metaclass=PoolMeta):
             if set(values.keys()) & cls._check_owners_fields:
                 all_accounts += accounts
         super().write(*args)
-        cls.check_owners(all_accounts)
+        cls._check_or_queue_owners(all_accounts)
+
+    @classmethod
+    def _check_owners_related(cls, Model, field_name, account_ids):
+        '''
+        Returns the from item, table and condition of the records of Model
+        that take one of the accounts from their party.
+        '''
+        pool = Pool()
+        PaymentType = pool.get('account.payment.type')
+        table = Model.__table__()
+        payment_type = PaymentType.__table__()
+        column = getattr(table, field_name)
+
+        from_ = table.join(payment_type, condition=(
+                payment_type.id == table.payment_type))
+        where = (fields.SQL_OPERATORS['in'](column, account_ids)
+            & (payment_type.account_bank == 'party')
+            & (table.party != Null))
+        return from_, table, where
 
     @classmethod
+    def _get_owners_violations(cls, accounts, limit=None):
+        '''
+        Yields the model, field name, record id and account id of the related
+        records whose party is not an owner of their bank account.
+        '''
+        pool = Pool()
+        AccountParty = pool.get('bank.account-party.party')
+        account_party = AccountParty.__table__()
+        cursor = Transaction().connection.cursor()
+
+        account_ids = [a.id for a in accounts]
+        for model_name, field_name in cls._check_owners_related_models:
+            Model = pool.get(model_name)
+            for sub_ids in grouped_slice(
+                    account_ids, backend.MAX_QUERY_PARAMS):
+                from_, table, where = cls._check_owners_related(
+                    Model, field_name, sub_ids)
+                column = getattr(table, field_name)
+                where &= ~Exists(account_party.select(Literal(1),
+                        where=((account_party.account == column)
+                            & (account_party.owner == table.party))))
+                cursor.execute(*from_.select(table.id, column,
+                        where=where, limit=limit))
+                for record_id, account_id in cursor.fetchall():
+                    yield Model, field_name, record_id, account_id
+
+    @classmethod
+    def _count_owners_related(cls, accounts):
+        '''
+        Returns the number of related records to check for the accounts.
+        '''
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        account_ids = [a.id for a in accounts]
+        count = 0
+        for model_name, field_name in cls._check_owners_related_models:
+            Model = pool.get(model_name)
+            for sub_ids in grouped_slice(
+                    account_ids, backend.MAX_QUERY_PARAMS):
+                from_, _, where = cls._check_owners_related(
+                    Model, field_name, sub_ids)
+                cursor.execute(*from_.select(Count(Literal('*')),
+                        where=where))
+                count += cursor.fetchone()[0]
+        return count
+
+    @classmethod
+    def _queue_owners(cls, accounts):
+        '''
+        Returns if the accounts are used by more records than the
+        check_owners_queue_threshold of the account_bank configuration
+        section.
+        '''
+        threshold = config.getint(
+            'account_bank', 'check_owners_queue_threshold', default=0)
+        return bool(accounts and threshold
+            and cls._count_owners_related(accounts) > threshold)
+
+    @classmethod
+    def _check_or_queue_owners(cls, accounts):
+        'Checks the owners of the accounts or queues their check'
+        if cls._queue_owners(accounts):
+            cls.__queue__.record_owners_violations(accounts)
+        else:
+            cls.check_owners(accounts)
+
+    @classmethod
+    def _record_or_queue_owners_violations(cls, accounts):
+        'Records the owner violations of the accounts or queues it'
+        if cls._queue_owners(accounts):
+            cls.__queue__.record_owners_violations(accounts)
+        else:
+            cls.record_owners_violations(accounts)
+
+    @classmethod
+    @instrumented
     def check_owners(cls, accounts):
+        if not accounts:
+            return
         with Transaction().set_context(_check_access=False):
-            pool = Pool()
-            IrModel = pool.get('ir.model')
-            Field = pool.get('ir.model.field')
-            account_ids = [a.id for a in accounts]
-            for value in cls._check_owners_related_models:
-                model_name, field_name = value
-                Model = pool.get(model_name)
-                records = Model.search([(field_name, 'in', account_ids)])
-                model, = IrModel.search([('name', '=', model_name)])
-                field, = Field.search([
-                        ('model.name', '=', model_name),
-                        ('name', '=', field_name),
-                        ], limit=1)
-                for record in records:
-                    target = record.account_bank_from
-                    if (not target or (record.payment_type
-                            and record.payment_type.account_bank != 'party')):
-                        continue
-                    account = getattr(record, field_name)
-                    if target not in account.owners:
-                        raise UserError(gettext(
-                            'account_bank.modify_with_related_model',
-                            account=account.rec_name,
-                            model=model.name,
-                            field=field.string,
-                            name=record.rec_name))
+            for Model, field_name, record_id, account_id in (
+                    cls._get_owners_violations(accounts, limit=1)):
+                names = Model.__names__(field_name)
+                raise UserError(gettext(
+                        'account_bank.modify_with_related_model',
+                        account=cls(account_id).rec_name,
+                        model=names['model'],
+                        field=names['field'],
+                        name=Model(record_id).rec_name))
+            # The violations recorded by a previous queued check are fixed
+            cls._delete_owners_violations(accounts)
+
+    @classmethod
+    def _delete_owners_violations(cls, accounts):
+        pool = Pool()
+        Violation = pool.get('bank.account.owner.violation')
+        Violation.delete(Violation.search([
+                    ('bank_account', 'in', [a.id for a in accounts]),
+                    ]))
+
+    @classmethod
+    def record_owners_violations(cls, accounts):
+        '''
+        Replaces the owner violations of the accounts by the current ones.
+        '''
+        pool = Pool()
+        Violation = pool.get('bank.account.owner.violation')
+
+        with Transaction().set_context(_check_access=False):
+            cls._delete_owners_violations(accounts)
+            Violation.create([{
+                        'bank_account': account_id,
+                        'origin': str(Model(record_id)),
+                        } for Model, _, record_id, account_id
+                    in cls._get_owners_violations(accounts)])
+
+
+class BankAccountOwnerViolation(ModelSQL, ModelView):
+    'Bank Account Owner Violation'
+    __name__ = 'bank.account.owner.violation'
+    bank_account = fields.Many2One('bank.account', 'Bank Account',
+        required=True, readonly=True, ondelete='CASCADE')
+    origin = fields.Reference('Origin', selection='get_origin',
+        required=True, readonly=True)
+    party = fields.Function(fields.Many2One('party.party', 'Party'),
+        'get_party')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    def get_origin(cls):
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
+        IrModel = pool.get('ir.model')
+        models = sorted(
+            {m for m, _ in BankAccount._check_owners_related_models})
+        return [(None, '')] + [(m, IrModel.get_name(m)) for m in models]
+
+    def get_party(self, name):
+        if self.origin and self.origin.id >= 0 and self.origin.party:
+            return self.origin.party.id
 
 
 class Party(metaclass=PoolMeta):
     __name__ = 'party.party'
 
     @classmethod
+    def _get_bank_account_owners(cls, party_ids):
+        '''
+        Returns the set of (account, owner) pairs of the parties.
+        '''
+        pool = Pool()
+        AccountParty = pool.get('bank.account-party.party')
+        account_party = AccountParty.__table__()
+        cursor = Transaction().connection.cursor()
+
+        owners = set()
+        for sub_ids in grouped_slice(
+                list(party_ids), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*account_party.select(
+                    account_party.account, account_party.owner,
+                    where=fields.SQL_OPERATORS['in'](
+                        account_party.owner, sub_ids)))
+            owners.update(tuple(r) for r in cursor)
+        return owners
+
+    @classmethod
+    @instrumented
     def write(cls, *args):
         pool = Pool()
         BankAccount = pool.get('bank.account')
         actions = iter(args)
-        all_accounts = []
+        party_ids = set()
         for parties, values in zip(actions, actions):
-            if set(values.keys()) & set(['bank_accounts']):
-                all_accounts += list(set(
-                        [a for p in parties for a in p.bank_accounts]))
+            if 'bank_accounts' in values:
+                party_ids.update(map(int, parties))
+        before = cls._get_bank_account_owners(party_ids)
         super().write(*args)
-        BankAccount.check_owners(all_accounts)
+        # Only removing an owner can leave a record with a bank account that
+        # does not belong to its party
+        removed = before - cls._get_bank_account_owners(party_ids)
+        BankAccount._check_or_queue_owners(
+            BankAccount.browse(list({a for a, _ in removed})))
 
 
 class BankMixin(object):
     __slots__ = ()
     account_bank = fields.Function(fields.Selection(ACCOUNT_BANK_KIND,
             'Account Bank'),
-        'on_change_with_account_bank')
+        'get_account_bank', searcher='search_account_bank')
     account_bank_from = fields.Function(fields.Many2One('party.party',
             'Account Bank From'),
-        'on_change_with_account_bank_from')
+        'get_account_bank_from')
     bank_account = fields.Many2One('bank.account', 'Bank Account',
         domain=[
             If(Eval('account_bank_from', None) == None,
@@ -154,6 +376,41 @@ class BankMixin(object):
             return self.payment_type.account_bank
         return 'none'
 
+    @classmethod
+    @instrumented
+    def get_account_bank(cls, records, name):
+        pool = Pool()
+        PaymentType = pool.get('account.payment.type')
+        table = cls.__table__()
+        payment_type = PaymentType.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys(map(int, records), 'none')
+        for sub_ids in grouped_slice(
+                list(result.keys()), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.join(payment_type, condition=(
+                        payment_type.id == table.payment_type)).select(
+                    table.id, payment_type.account_bank,
+                    where=fields.SQL_OPERATORS['in'](table.id, sub_ids)))
+            result.update(cursor)
+        return result
+
+    @classmethod
+    @instrumented
+    def search_account_bank(cls, name, clause):
+        pool = Pool()
+        PaymentType = pool.get('account.payment.type')
+        table = cls.__table__()
+        payment_type = PaymentType.__table__()
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = table.join(payment_type, 'LEFT', condition=(
+                payment_type.id == table.payment_type)).select(table.id,
+            where=Operator(Coalesce(payment_type.account_bank, 'none'),
+                value))
+        return [('id', 'in', query)]
+
     def _get_bank_account(self):
         pool = Pool()
         Party = pool.get('party.party')
@@ -198,6 +455,94 @@ class BankMixin(object):
             self.bank_account = None
             return
 
+    @classmethod
+    def _get_bank_accounts(cls, records):
+        '''
+        Sets the bank account of all the records like _get_bank_account
+        reading their payment types, companies and parties at once.
+        '''
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        PaymentType = pool.get('account.payment.type')
+
+        def read(Model, ids, names):
+            return {r['id']: r for r in Model.read(list(ids), names)}
+
+        to_resolve = [r for r in records if r.party and r.payment_type]
+        payment_types = read(PaymentType,
+            {r.payment_type.id for r in to_resolve},
+            ['account_bank', 'kind', 'bank_account'])
+        by_company = [r for r in to_resolve
+            if payment_types[r.payment_type.id]['account_bank'] == 'company']
+        companies = read(Company,
+            {r.company.id for r in by_company
+                if getattr(r, 'company', None)},
+            ['party'])
+        company_parties = read(Party,
+            {c['party'] for c in companies.values()},
+            [f for f in ['bank_accounts'] if f in Party._fields])
+
+        # The parties to read for each bank account field
+        to_read = defaultdict(set)
+        for record in to_resolve:
+            payment_type = payment_types[record.payment_type.id]
+            kind = payment_type['kind']
+            if payment_type['account_bank'] == 'party':
+                to_read[kind + '_bank_account'].add(record.party.id)
+            elif payment_type['account_bank'] == 'company':
+                to_read[kind + '_company_bank_account'].add(record.party.id)
+                company = getattr(record, 'company', None)
+                if company:
+                    to_read[kind + '_bank_account'].add(
+                        companies[company.id]['party'])
+        values = {}
+        for fname, party_ids in to_read.items():
+            if fname in Party._fields:
+                for party_id, party in read(
+                        Party, party_ids, [fname]).items():
+                    values[(fname, party_id)] = party[fname]
+
+        def bank_account(id_):
+            return BankAccount(id_) if id_ is not None else None
+
+        for record in records:
+            if not record.party or not record.payment_type:
+                record.bank_account = None
+                continue
+            payment_type = payment_types[record.payment_type.id]
+            account_bank = payment_type['account_bank']
+            party_fname = '%s_bank_account' % payment_type['kind']
+            if account_bank == 'none':
+                record.bank_account = None
+            elif account_bank == 'other':
+                record.bank_account = bank_account(
+                    payment_type['bank_account'])
+            elif party_fname not in Party._fields:
+                continue
+            elif account_bank == 'company':
+                company = getattr(record, 'company', None)
+                current = getattr(record, 'bank_account', None)
+                if company:
+                    company_party = companies[company.id]['party']
+                    if current and current.id in company_parties[
+                            company_party].get('bank_accounts', []):
+                        continue
+                company_bank = values.get(
+                    ('%s_company_bank_account' % payment_type['kind'],
+                        record.party.id))
+                if company_bank:
+                    record.bank_account = bank_account(company_bank)
+                elif company:
+                    record.bank_account = bank_account(
+                        values.get((party_fname, company_party)))
+            elif account_bank == 'party':
+                record.bank_account = bank_account(
+                    values.get((party_fname, record.party.id)))
+            else:
+                record.bank_account = None
+
     @fields.depends('party', 'payment_type', 'bank_account',
         methods=['on_change_with_payment_type'])
     def on_change_payment_type(self):
@@ -209,19 +554,24 @@ class BankMixin(object):
         '''
         Sets the party where get bank account for this move line.
         '''
-        Company = Pool().get('company.company')
+        PaymentType = Pool().get('account.payment.type')
 
         if self.payment_type and self.party:
-            payment_type = self.payment_type
-            party = self.party
-            if payment_type.account_bank == 'party':
-                return party.id
-            elif payment_type.account_bank == 'company':
-                company_id = Transaction().context.get('company')
-                if company_id is not None and company_id >= 0:
-                    return Company(company_id).party.id
-            elif payment_type.account_bank == 'other':
-                return payment_type.party.id
+            return PaymentType.get_account_bank_from(self.payment_type.id,
+                self.party.id, Transaction().context.get('company'))
+
+    @classmethod
+    def get_account_bank_from(cls, records, name):
+        PaymentType = Pool().get('account.payment.type')
+
+        company_id = Transaction().context.get('company')
+        result = {}
+        for record in records:
+            result[record.id] = None
+            if record.payment_type and record.party:
+                result[record.id] = PaymentType.get_account_bank_from(
+                    record.payment_type.id, record.party.id, company_id)
+        return result
 
 
 class Invoice(BankMixin, metaclass=PoolMeta):
@@ -258,44 +608,136 @@ class Invoice(BankMixin, metaclass=PoolMeta):
             self._get_bank_account()
 
     @classmethod
+    @instrumented
     def post(cls, invoices):
         '''
         Check up invoices that requires bank account because its payment type,
         has one
         '''
-        to_save = []
-        for invoice in invoices:
-            account_bank = (invoice.payment_type and
-                invoice.payment_type.account_bank or 'none')
-            if (invoice.payment_type and account_bank != 'none'
-                    and not invoice.bank_account):
-                invoice._get_bank_account()
-                if not invoice.bank_account:
-                    raise UserError(gettext(
-                        'account_bank.invoice_without_bank_account',
-                            invoice=invoice.rec_name,
-                            payment_type=invoice.payment_type.rec_name))
-
-                to_save.append(invoice)
-        if to_save:
-            cls.save(to_save)
+        to_update = [i for i in invoices
+            if (i.payment_type and i.payment_type.account_bank != 'none'
+                and not i.bank_account)]
+        cls._get_bank_accounts(to_update)
+        missing = [i for i in to_update if not i.bank_account]
+        if len(missing) == 1:
+            invoice, = missing
+            raise UserError(gettext(
+                'account_bank.invoice_without_bank_account',
+                    invoice=invoice.rec_name,
+                    payment_type=invoice.payment_type.rec_name))
+        elif missing:
+            names = ', '.join(i.rec_name for i in missing[:5])
+            if len(missing) > 5:
+                names += '...'
+            raise UserError(gettext(
+                'account_bank.invoices_without_bank_account',
+                    invoices=names))
+
+        to_write = defaultdict(list)
+        for invoice in to_update:
+            to_write[invoice.bank_account.id].append(invoice)
+        if to_write:
+            cls.write(*chain(*(
+                        (records, {'bank_account': bank_account})
+                        for bank_account, records in to_write.items())))
         super().post(invoices)
 
+    @classmethod
+    @instrumented
+    def _set_move_lines_bank_account(cls, moves):
+        '''
+        Sets the bank account of the invoices of the moves on their lines with
+        the invoice account and without bank account, with one query per bank
+        account.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        line = Line.__table__()
+        invoice = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        to_update = defaultdict(list)
+        for sub_ids in grouped_slice(
+                list(map(int, moves)), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(invoice, condition=(
+                        (invoice.move == line.move)
+                        & (invoice.account == line.account))).select(
+                    invoice.bank_account, line.id,
+                    where=(fields.SQL_OPERATORS['in'](line.move, sub_ids)
+                        & (invoice.bank_account != Null)
+                        & (line.bank_account == Null))))
+            for bank_account_id, line_id in cursor:
+                to_update[bank_account_id].append(line_id)
+        if not to_update:
+            return
+
+        for bank_account_id, line_ids in to_update.items():
+            for sub_ids in grouped_slice(line_ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*line.update(
+                        [line.bank_account, line.write_uid, line.write_date],
+                        [bank_account_id, transaction.user,
+                            CurrentTimestamp()],
+                        where=fields.SQL_OPERATORS['in'](line.id, sub_ids)))
+
+        # Invalidate the cache of the lines updated without write
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if Line.__name__ in cache:
+                cache_cls = cache[Line.__name__]
+                for line_id in chain(*to_update.values()):
+                    cache_cls.pop(line_id, None)
+
+    @instrumented
     def _get_move_line(self, date, amount):
-        '''Add account bank to move line when post invoice.'''
-        line = super()._get_move_line(date, amount)
-        if self.bank_account:
-            line.bank_account = self.bank_account
-        return line
+        return super()._get_move_line(date, amount)
 
     @fields.depends('payment_type', 'party', 'company', 'bank_account')
     def on_change_lines(self):
+        # The bank account set by the on_change of the party, payment type or
+        # company is kept unless the lines change them
+        previous = (self.party, self.payment_type, self.company)
         super().on_change_lines()
-        self.bank_account = None
-        if self.payment_type:
+        if not self.payment_type:
+            self.bank_account = None
+        elif (not self.bank_account
+                or previous != (self.party, self.payment_type, self.company)):
             self._get_bank_account()
 
 
+class Account(metaclass=PoolMeta):
+    __name__ = 'account.account'
+
+    @classmethod
+    def on_modification(cls, mode, accounts, field_names=None):
+        OpenBalance = Pool().get('account.move.line.open_balance')
+        super().on_modification(mode, accounts, field_names=field_names)
+        if mode == 'write' and 'reconcile' in field_names:
+            OpenBalance.refresh_accounts(accounts)
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'account.move'
+
+    @dualmethod
+    @ModelView.button
+    def post(cls, moves):
+        Invoice = Pool().get('account.invoice')
+        # The bank account of the invoices is set on their lines at once
+        # instead of on each line when building the moves
+        Invoice._set_move_lines_bank_account(moves)
+        super().post(moves)
+
+    @classmethod
+    def on_write(cls, moves, values):
+        OpenBalance = Pool().get('account.move.line.open_balance')
+        callback = super().on_write(moves, values)
+        if OpenBalance._move_fields & values.keys():
+            line_ids = OpenBalance.before_write_moves(moves)
+            callback.append(lambda: OpenBalance.after_write_lines(line_ids))
+        return callback
+
+
 class Line(BankMixin, metaclass=PoolMeta):
     __name__ = 'account.move.line'
 
@@ -348,116 +790,208 @@ class Line(BankMixin, metaclass=PoolMeta):
             default['bank_account'] = None
         return super().copy(lines, default)
 
-    def get_reverse_moves(self, name):
-        if (not self.account
-                or (self.account.type.receivable == False and
-                    self.account.type.payable == False)):
-            return False
-        domain = [
-            ('account', '=', self.account.id),
-            ('reconciliation', '=', None),
-            ]
-        if self.party:
-            domain.append(('party', '=', self.party.id))
-        if self.credit > Decimal(0):
-            domain.append(('debit', '>', 0))
-        if self.debit > Decimal(0):
-            domain.append(('credit', '>', 0))
-        moves = self.search(domain, limit=1)
-        return len(moves) > 0
+    @classmethod
+    def on_write(cls, lines, values):
+        OpenBalance = Pool().get('account.move.line.open_balance')
+        callback = super().on_write(lines, values)
+        if OpenBalance._line_fields & values.keys():
+            line_ids = OpenBalance.before_write_lines(lines)
+            callback.append(lambda: OpenBalance.after_write_lines(line_ids))
+        return callback
 
     @classmethod
-    def search_reverse_moves(cls, name, clause):
+    def on_modification(cls, mode, lines, field_names=None):
+        OpenBalance = Pool().get('account.move.line.open_balance')
+        super().on_modification(mode, lines, field_names=field_names)
+        if mode == 'create':
+            OpenBalance.add_lines(lines)
+        elif mode == 'delete':
+            OpenBalance.delete_lines(lines)
+        elif OpenBalance._line_fields & field_names:
+            OpenBalance.refresh_lines(lines)
+
+    @classmethod
+    def _reverse_moves_query(cls, accounts=None):
+        '''
+        Returns the query of unreconciled lines grouped by account and party
+        with whether each group has debit and credit amounts.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        OpenBalance = pool.get('account.move.line.open_balance')
+        balance = OpenBalance.__table__()
+        account = Account.__table__()
+
+        where = account.reconcile & (balance.line_count > 0)
+        if accounts is not None:
+            where &= fields.SQL_OPERATORS['in'](balance.account, accounts)
+        return balance.join(account, condition=(
+                account.id == balance.account)).select(
+                    balance.account, balance.party,
+                    (balance.debit_count > 0).as_('debit'),
+                    (balance.credit_count > 0).as_('credit'),
+                    where=where)
+
+    @classmethod
+    @instrumented
+    def get_reverse_moves(cls, lines, name):
         pool = Pool()
         Account = pool.get('account.account')
-        MoveLine = pool.get('account.move.line')
-        operator = 'in' if clause[2] else 'not in'
-        lines = MoveLine.__table__()
-        move_line = MoveLine.__table__()
+        AccountType = pool.get('account.account.type')
+        line = cls.__table__()
         account = Account.__table__()
+        account_type = AccountType.__table__()
         cursor = Transaction().connection.cursor()
 
-        reverse = move_line.join(account, condition=(
-                account.id == move_line.account)).select(
-                    move_line.account, move_line.party,
-                    where=(account.reconcile
-                        & (move_line.reconciliation == Null)),
-                    group_by=(move_line.account, move_line.party),
-                    having=((BoolOr((move_line.debit) != Decimal(0)))
-                        & (BoolOr((move_line.credit) != Decimal(0))))
+        result = dict.fromkeys(map(int, lines), False)
+        for sub_ids in grouped_slice(
+                list(result.keys()), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(account, condition=(
+                        account.id == line.account)).join(account_type,
+                    condition=(account_type.id == account.type)).select(
+                    line.id, line.account, line.party, line.debit,
+                    line.credit,
+                    where=(fields.SQL_OPERATORS['in'](line.id, sub_ids)
+                        & (account_type.receivable | account_type.payable))))
+            to_check = cursor.fetchall()
+            if not to_check:
+                continue
+
+            # Lines without party are compared with all the lines of their
+            # account
+            party_flags, account_flags = {}, {}
+            cursor.execute(*cls._reverse_moves_query(
+                    list({x[1] for x in to_check})))
+            for account_id, party_id, debit, credit in cursor:
+                party_flags[(account_id, party_id)] = (debit, credit)
+                account_debit, account_credit = account_flags.get(
+                    account_id, (False, False))
+                account_flags[account_id] = (
+                    account_debit or debit, account_credit or credit)
+
+            for line_id, account_id, party_id, debit, credit in to_check:
+                if party_id is not None:
+                    flags = party_flags.get((account_id, party_id))
+                else:
+                    flags = account_flags.get(account_id)
+                if not flags:
+                    continue
+                has_debit, has_credit = flags
+                result[line_id] = bool((not credit or has_debit)
+                    and (not debit or has_credit))
+        return result
+
+    @classmethod
+    @instrumented
+    def search_reverse_moves(cls, name, clause):
+        line = cls.__table__()
+        _, operator, value = clause
+        if operator == '!=':
+            value = not value
+
+        reverse = cls._reverse_moves_query()
+        condition = Exists(reverse.select(Literal(1),
+                where=((reverse.account == line.account)
+                    & (reverse.party == line.party)
+                    & reverse.debit & reverse.credit)))
+        if not value:
+            condition = ~condition
+        return [('id', 'in', line.select(line.id, where=condition))]
+
+    @classmethod
+    def _netting_moves_query(cls, companies, parties=None):
+        '''
+        Returns the query of the company and party pairs that have posted and
+        unreconciled receivable or payable lines both on debit and credit.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        OpenBalance = pool.get('account.move.line.open_balance')
+        balance = OpenBalance.__table__()
+        account = Account.__table__()
+        account_type = AccountType.__table__()
+
+        where = (account.reconcile
+            & (account_type.receivable | account_type.payable)
+            & (balance.party != Null)
+            & balance.company.in_(companies))
+        if parties is not None:
+            where &= fields.SQL_OPERATORS['in'](balance.party, parties)
+        return balance.join(account, condition=(
+                account.id == balance.account)).join(account_type, condition=(
+                    account_type.id == account.type)).select(
+                    balance.company, balance.party,
+                    where=where,
+                    group_by=(balance.party, balance.company),
+                    having=((Sum(balance.posted_debit_count) > 0)
+                        & (Sum(balance.posted_credit_count) > 0))
                     )
-        query = lines.select(lines.id, where=(
-                In((lines.account, lines.party), reverse)))
-        # Fetch the data otherwise its too slow
-        cursor.execute(*query)
-
-        return [('id', operator, [x[0] for x in cursor.fetchall()])]
-
-    def get_netting_moves(self, name):
-        if (not self.account
-                or (self.account.type.receivable == False and
-                    self.account.type.payable == False)):
-            return False
-        if not self.account.party_required or not self.party:
-            return False
-        domain = [
-            ('party', '=', self.party.id),
-            ('reconciliation', '=', None),
-            ['OR',
-                ('debit', '!=', 0),
-                ('credit', '!=', 0),
-            ],
-            ['OR',
-                ('account.type.receivable', '=', True),
-                ('account.type.payable', '=', True)
-            ],
-            ('move.company', '=', self.move.company)
-            ]
-        moves = self.search(domain, limit=1)
-        return len(moves) > 0
 
     @classmethod
-    def search_netting_moves(cls, name, clause):
+    @instrumented
+    def get_netting_moves(cls, lines, name):
         pool = Pool()
         Account = pool.get('account.account')
-        MoveLine = pool.get('account.move.line')
         Move = pool.get('account.move')
         AccountType = pool.get('account.account.type')
-        Rule = pool.get('ir.rule')
-        operator = 'in' if clause[2] else 'not in'
-        lines = MoveLine.__table__()
+        line = cls.__table__()
         move = Move.__table__()
-        move_line = MoveLine.__table__()
         account = Account.__table__()
         account_type = AccountType.__table__()
         cursor = Transaction().connection.cursor()
 
+        result = dict.fromkeys(map(int, lines), False)
+        # All the lines of a company and party share the same value
+        netting = {}
+        for sub_ids in grouped_slice(
+                list(result.keys()), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(move, condition=(
+                        move.id == line.move)).join(account, condition=(
+                        account.id == line.account)).join(account_type,
+                    condition=(account_type.id == account.type)).select(
+                    line.id, move.company, line.party,
+                    where=(fields.SQL_OPERATORS['in'](line.id, sub_ids)
+                        & (account_type.receivable | account_type.payable)
+                        & account.party_required
+                        & (line.party != Null))))
+            to_check = cursor.fetchall()
+            pending = {(c, p) for _, c, p in to_check} - netting.keys()
+            if pending:
+                netting.update(dict.fromkeys(pending, False))
+                cursor.execute(*cls._netting_moves_query(
+                        list({c for c, _ in pending}),
+                        list({p for _, p in pending})))
+                netting.update((tuple(r), True) for r in cursor)
+            for line_id, company_id, party_id in to_check:
+                result[line_id] = netting[(company_id, party_id)]
+        return result
+
+    @classmethod
+    @instrumented
+    def search_netting_moves(cls, name, clause):
+        pool = Pool()
+        Move = pool.get('account.move')
+        Rule = pool.get('ir.rule')
+        line = cls.__table__()
+        move = Move.__table__()
+        _, operator, value = clause
+        if operator == '!=':
+            value = not value
+
         companies = Rule._get_context(cls.__name__).get('companies')
         if not companies:
             companies = [-1]
-        company_filter = move.company.in_(companies)
-
-        netting = move_line.join(account, condition=(
-                account.id == move_line.account)).join(move, condition=(
-                    move.id == move_line.move)).join(account_type, condition=(
-                        account_type.id == account.type)).select(
-                    move.company, move_line.party,
-                    where=(account.reconcile
-                        & (move_line.reconciliation == Null)
-                        & (move.state == 'posted')
-                        & (account_type.receivable | account_type.payable)
-                        & (move_line.party != Null))
-                        & company_filter,
-                    group_by=(move_line.party, move.company),
-                    having=((BoolOr((move_line.debit) != Decimal(0)))
-                        & (BoolOr((move_line.credit) != Decimal(0))))
-                    )
-        query = lines.join(move, condition=(move.id == lines.move)).select(lines.id, where=(
-                In((move.company, lines.party), netting)))
-        # Fetch the data otherwise its too slow
-        cursor.execute(*query)
 
-        return [('id', operator, [x[0] for x in cursor.fetchall()])]
+        netting = cls._netting_moves_query(companies)
+        condition = Exists(netting.select(Literal(1),
+                where=((netting.company == move.company)
+                    & (netting.party == line.party))))
+        if not value:
+            condition = ~condition
+        return [('id', 'in', line.join(move,
+                    condition=(move.id == line.move)).select(
+                    line.id, where=condition))]
 
     @fields.depends('_parent_move.id')
     def on_change_with_account_bank_from(self, name=None):
@@ -473,6 +1007,507 @@ class Line(BankMixin, metaclass=PoolMeta):
                 kind = 'payable'
         return kind
 
+    @classmethod
+    def get_compensation_line(cls, line):
+        'Returns the counterpart line to compensate line'
+        new_line = cls()
+        new_line.account = line.account
+        new_line.debit = line.credit
+        new_line.credit = line.debit
+        new_line.description = line.description
+        new_line.second_currency = line.second_currency
+        if line.second_currency:
+            new_line.amount_second_currency = -line.amount_second_currency
+        new_line.party = line.party
+        return new_line
+
+    @classmethod
+    def _get_compensation_groups(cls, lines):
+        '''
+        Returns the posted and unreconciled receivable and payable lines
+        grouped by company and party.
+        '''
+        groups = defaultdict(list)
+        for line in lines:
+            if (line.reconciliation or not line.party
+                    or line.move.state != 'posted'
+                    or not (line.account.type.receivable
+                        or line.account.type.payable)):
+                continue
+            groups[(line.move.company, line.party)].append(line)
+        return groups
+
+    @classmethod
+    def _get_netting_line_ids(cls, companies):
+        '''
+        Yields the company id, party id and the ids of the posted and
+        unreconciled receivable and payable lines of each party with netting
+        moves in the companies.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        Move = pool.get('account.move')
+        line = cls.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+        account_type = AccountType.__table__()
+        cursor = Transaction().connection.cursor()
+
+        netting = cls._netting_moves_query(companies)
+        cursor.execute(*line.join(move, condition=(
+                    move.id == line.move)).join(account, condition=(
+                    account.id == line.account)).join(account_type,
+                condition=(account_type.id == account.type)).select(
+                move.company, line.party, line.id,
+                where=((move.state == 'posted')
+                    & (line.reconciliation == Null)
+                    & (account_type.receivable | account_type.payable)
+                    & Exists(netting.select(Literal(1),
+                            where=((netting.company == move.company)
+                                & (netting.party == line.party))))),
+                order_by=(move.company, line.party, line.id)))
+        # Fetch the ids before compensating the first party with the same
+        # connection
+        for (company_id, party_id), rows in groupby(
+                cursor.fetchall(), key=lambda r: (r[0], r[1])):
+            yield company_id, party_id, [r[2] for r in rows]
+
+    @classmethod
+    def _get_compensation_move(cls, company, party, lines, date=None,
+            maturity_date=None, description=None):
+        '''
+        Returns the move, counterpart lines and extra lines to compensate the
+        lines of the party.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        Party = pool.get('party.party')
+
+        with Transaction().set_context(company=company.id):
+            if date is None:
+                date = Date.today()
+            party = Party(party.id)
+            move = Move()
+            move.company = company
+            move.period = Period.find(company, date=date)
+            move.journal = lines[0].move.journal
+            move.date = date
+            move.description = description
+
+            counterparts = [cls.get_compensation_line(l) for l in lines]
+            amount = sum((l.debit - l.credit for l in lines), Decimal(0))
+            extra_lines = []
+            if not company.currency.is_zero(amount):
+                extra_line = cls()
+                extra_line.party = party
+                extra_line.maturity_date = maturity_date
+                extra_line.description = description
+                extra_line.debit = extra_line.credit = Decimal(0)
+                if amount > 0:
+                    extra_line.account = party.account_receivable_used
+                    extra_line.payment_type = party.customer_payment_type
+                    extra_line.debit = amount
+                else:
+                    extra_line.account = party.account_payable_used
+                    extra_line.payment_type = party.supplier_payment_type
+                    extra_line.credit = -amount
+                cls._get_bank_accounts([extra_line])
+                extra_lines.append(extra_line)
+        return move, counterparts, extra_lines
+
+    @classmethod
+    def _post_compensation_moves(cls, moves):
+        '''
+        Saves and posts the compensation moves and reconciles their lines.
+        moves is a list of tuples with the move, the compensated lines, their
+        counterparts and the extra lines.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        # Save the lines on their own so the counterparts keep their ids and
+        # can be reconciled without comparing them with the extra lines
+        Move.save([m for m, _, _, _ in moves])
+        to_save = []
+        for move, _, counterparts, extra_lines in moves:
+            for line in counterparts + extra_lines:
+                line.move = move
+                to_save.append(line)
+        cls.save(to_save)
+        Move.post([m for m, _, _, _ in moves])
+        for _, lines, counterparts, _ in moves:
+            to_reconcile = defaultdict(list)
+            for line in chain(lines, counterparts):
+                to_reconcile[line.account.id].append(line)
+            for lines_to_reconcile in to_reconcile.values():
+                cls.reconcile(lines_to_reconcile)
+
+    @classmethod
+    @instrumented
+    def compensate(cls, lines, date=None, maturity_date=None,
+            description=None):
+        '''
+        Creates, posts and reconciles a balanced compensation move for each
+        company and party of the lines with amounts on debit and credit.
+        '''
+        moves = []
+        for (company, party), group in (
+                cls._get_compensation_groups(lines).items()):
+            if (not any(l.debit for l in group)
+                    or not any(l.credit for l in group)):
+                continue
+            move, counterparts, extra_lines = cls._get_compensation_move(
+                company, party, group, date=date,
+                maturity_date=maturity_date, description=description)
+            moves.append((move, group, counterparts, extra_lines))
+        if moves:
+            cls._post_compensation_moves(moves)
+        return [m for m, _, _, _ in moves]
+
+
+class LineOpenBalance(ModelSQL):
+    'Move Line Open Balance'
+    __name__ = 'account.move.line.open_balance'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    account = fields.Many2One('account.account', 'Account', required=True,
+        ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', ondelete='CASCADE')
+    line_count = fields.Integer('Lines', required=True)
+    debit_count = fields.Integer('Debit Lines', required=True)
+    credit_count = fields.Integer('Credit Lines', required=True)
+    posted_debit_count = fields.Integer('Posted Debit Lines', required=True)
+    posted_credit_count = fields.Integer('Posted Credit Lines',
+        required=True)
+    debit = fields.Numeric('Debit', digits=(16, 2), required=True)
+    credit = fields.Numeric('Credit', digits=(16, 2), required=True)
+
+    # Line and move fields that change the balance of a line
+    _line_fields = {'move', 'account', 'party', 'debit', 'credit',
+        'reconciliation'}
+    _move_fields = {'state', 'company'}
+    _balance_fields = ['line_count', 'debit_count', 'credit_count',
+        'posted_debit_count', 'posted_credit_count', 'debit', 'credit']
+
+    # The ids of the lines removed from the balances until they or their move
+    # are written for each transaction
+    _written_lines = WeakKeyDictionary()
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_account_party_unique',
+                Unique(t, t.company, t.account, t.party),
+                'account_bank.open_balance_unique'),
+            ('company_account_unique',
+                Exclude(t, (t.company, Equal), (t.account, Equal),
+                    where=t.party == Null),
+                'account_bank.open_balance_unique'),
+            ]
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.account, Index.Range()),
+                    (t.party, Index.Range())),
+                Index(
+                    t,
+                    (t.party, Index.Range()),
+                    (t.company, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        if not exist:
+            cls._refresh(lambda t: Literal(True))
+
+    @classmethod
+    def add_lines(cls, lines):
+        'Adds the lines to the balances'
+        for sub_ids in grouped_slice(
+                list(map(int, lines)), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cls._update(
+                lambda l: fields.SQL_OPERATORS['in'](l.id, sub_ids), 1)
+
+    @classmethod
+    def remove_lines(cls, lines):
+        'Removes the lines from the balances'
+        for sub_ids in grouped_slice(
+                list(map(int, lines)), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cls._update(
+                lambda l: fields.SQL_OPERATORS['in'](l.id, sub_ids), -1)
+
+    @classmethod
+    def before_write_lines(cls, lines):
+        '''
+        Removes the lines from the balances until they are written and returns
+        the ids to pass to after_write_lines.
+        The lines already removed, like by the write of their move, are
+        skipped.
+        '''
+        written = cls._written_lines.setdefault(Transaction(), set())
+        line_ids = [l for l in map(int, lines) if l not in written]
+        cls.remove_lines(line_ids)
+        written.update(line_ids)
+        return line_ids
+
+    @classmethod
+    def before_write_moves(cls, moves):
+        '''
+        Removes the lines of the moves from the balances until the moves are
+        written and returns the ids to pass to after_write_lines.
+        '''
+        line = Pool().get('account.move.line').__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = []
+        for sub_ids in grouped_slice(
+                list(map(int, moves)), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.select(line.id,
+                    where=fields.SQL_OPERATORS['in'](line.move, sub_ids)))
+            line_ids.extend(l for l, in cursor)
+        return cls.before_write_lines(line_ids)
+
+    @classmethod
+    def after_write_lines(cls, line_ids):
+        'Adds back the lines removed by before_write_lines that still exist'
+        written = cls._written_lines.get(Transaction(), set())
+        to_add = [l for l in line_ids if l in written]
+        written.difference_update(to_add)
+        cls.add_lines(to_add)
+
+    @classmethod
+    def delete_lines(cls, lines):
+        'Removes the deleted lines that are not already removed'
+        written = cls._written_lines.get(Transaction(), set())
+        line_ids = list(map(int, lines))
+        to_remove = [l for l in line_ids if l not in written]
+        written.difference_update(line_ids)
+        cls.remove_lines(to_remove)
+
+    @classmethod
+    def refresh_lines(cls, lines):
+        '''
+        Recomputes the balances of the lines written without
+        before_write_lines, like by the party replacement.
+        '''
+        written = cls._written_lines.get(Transaction(), set())
+        to_refresh = [l for l in map(int, lines) if l not in written]
+        if to_refresh:
+            cls.refresh(cls.get_line_keys(to_refresh))
+
+    @classmethod
+    def get_line_keys(cls, lines):
+        'Returns the set of account and party of the lines'
+        line = Pool().get('account.move.line').__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = set()
+        for sub_ids in grouped_slice(
+                list(map(int, lines)), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.select(line.account, line.party,
+                    where=fields.SQL_OPERATORS['in'](line.id, sub_ids),
+                    group_by=(line.account, line.party)))
+            keys.update(cursor)
+        return keys
+
+    @classmethod
+    def refresh(cls, keys):
+        'Recomputes the balances of the account and party pairs'
+        for sub_keys in grouped_slice(
+                list(set(keys)), backend.MAX_QUERY_PARAMS // 2):
+            parties = defaultdict(list)
+            for account_id, party_id in sub_keys:
+                parties[account_id].append(party_id)
+            cls._refresh(
+                lambda t: cls._keys_condition(t, parties))
+
+    @staticmethod
+    def _keys_condition(table, parties):
+        condition = Literal(False)
+        for account_id, party_ids in parties.items():
+            party_condition = Literal(False)
+            if None in party_ids:
+                party_condition |= table.party == Null
+            party_ids = [p for p in party_ids if p is not None]
+            if party_ids:
+                party_condition |= table.party.in_(party_ids)
+            condition |= (table.account == account_id) & party_condition
+        return condition
+
+    @classmethod
+    def refresh_accounts(cls, accounts):
+        'Recomputes the balances of the accounts'
+        for sub_ids in grouped_slice(
+                list(map(int, accounts)), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cls._refresh(
+                lambda t: fields.SQL_OPERATORS['in'](t.account, sub_ids))
+
+    @classmethod
+    def refresh_parties(cls, parties):
+        'Recomputes the balances of the parties'
+        for sub_ids in grouped_slice(
+                list(map(int, parties)), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cls._refresh(
+                lambda t: fields.SQL_OPERATORS['in'](t.party, sub_ids))
+
+    @classmethod
+    def rebuild(cls):
+        'Recomputes all the balances'
+        cls._refresh(lambda t: Literal(True))
+
+    @classmethod
+    def _balance_query(cls, where, sign=1):
+        '''
+        Returns the query of the balances of the unreconciled lines matching
+        where multiplied by sign.
+        where is a callable that returns the condition for a table with
+        account and party columns.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Account = pool.get('account.account')
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+
+        def count(condition):
+            return Sum(Case((condition, sign), else_=0))
+
+        posted = move.state == 'posted'
+        return line.join(move, condition=move.id == line.move).join(
+            account, condition=account.id == line.account).select(
+                move.company.as_('company'),
+                line.account.as_('account'),
+                line.party.as_('party'),
+                (Count(Literal('*')) * sign).as_('line_count'),
+                count(line.debit != Decimal(0)).as_('debit_count'),
+                count(line.credit != Decimal(0)).as_('credit_count'),
+                count((line.debit != Decimal(0)) & posted).as_(
+                    'posted_debit_count'),
+                count((line.credit != Decimal(0)) & posted).as_(
+                    'posted_credit_count'),
+                (Sum(line.debit) * sign).as_('debit'),
+                (Sum(line.credit) * sign).as_('credit'),
+                where=(account.reconcile
+                    & (line.reconciliation == Null)
+                    & where(line)),
+                group_by=(move.company, line.account, line.party))
+
+    @staticmethod
+    def _same_key(table, query):
+        return ((table.company == query.company)
+            & (table.account == query.account)
+            & ((table.party == query.party)
+                | ((table.party == Null) & (query.party == Null))))
+
+    @classmethod
+    def _insert_missing(cls, query):
+        '''
+        Inserts empty balances for the keys of query without balance.
+        The concurrent inserts of the same key wait on the unique constraints
+        and do nothing instead of failing.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        existing = cls.__table__()
+
+        on_conflict = None
+        if transaction.database.has_insert_on_conflict():
+            on_conflict = Conflict(table)
+        cursor.execute(*table.insert(
+                [table.create_uid, table.create_date,
+                    table.company, table.account, table.party]
+                + [getattr(table, f) for f in cls._balance_fields],
+                query.select(
+                    Literal(transaction.user), CurrentTimestamp(),
+                    query.company, query.account, query.party,
+                    *[Literal(0)] * len(cls._balance_fields),
+                    where=~Exists(existing.select(Literal(1),
+                            where=cls._same_key(existing, query)))),
+                on_conflict=on_conflict))
+
+    @classmethod
+    def _lock_balances(cls, table, where):
+        '''
+        Locks the balances matching where in key order so concurrent updates
+        of the same keys do not deadlock.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if transaction.database.has_select_for():
+            cursor.execute(*table.select(Literal(1),
+                    where=where,
+                    order_by=[table.company, table.account, table.party],
+                    for_=For('UPDATE')))
+
+    @classmethod
+    def _update(cls, where, sign):
+        '''
+        Adds the balances of the unreconciled lines matching where multiplied
+        by sign to the balances of their company, account and party.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        deltas = cls._balance_query(where, sign)
+        cls._insert_missing(deltas)
+        cls._lock_balances(table, Exists(deltas.select(Literal(1),
+                    where=cls._same_key(table, deltas))))
+        cursor.execute(*table.update(
+                [getattr(table, f) for f in cls._balance_fields]
+                + [table.write_uid, table.write_date],
+                [getattr(table, f) + getattr(deltas, f)
+                    for f in cls._balance_fields]
+                + [transaction.user, CurrentTimestamp()],
+                from_=[deltas],
+                where=cls._same_key(table, deltas)))
+
+    @classmethod
+    def _refresh(cls, where):
+        '''
+        Replaces the balances matching where by the aggregate of the
+        unreconciled lines matching it and deletes those without lines.
+        where is a callable that returns the condition for a table with
+        account and party columns.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        stale = cls.__table__()
+
+        query = cls._balance_query(where)
+        cls._insert_missing(query)
+        cls._lock_balances(table, where(table))
+        cursor.execute(*table.update(
+                [getattr(table, f) for f in cls._balance_fields]
+                + [table.write_uid, table.write_date],
+                [getattr(query, f) for f in cls._balance_fields]
+                + [transaction.user, CurrentTimestamp()],
+                from_=[query],
+                where=cls._same_key(table, query)))
+        cursor.execute(*table.delete(
+                where=table.id.in_(stale.select(stale.id,
+                        where=where(stale)
+                        & ~Exists(query.select(Literal(1),
+                                where=cls._same_key(stale, query)))))))
+
 
 class CompensationMoveStart(ModelView, BankMixin):
     'Create Compensation Move Start'
@@ -497,6 +1532,13 @@ class CompensationMoveStart(ModelView, BankMixin):
         domain=[
             ('kind', '=', Eval('payment_kind'))
             ])
+    max_lines = fields.Integer('Maximum Lines per Move',
+        domain=['OR',
+            ('max_lines', '=', None),
+            ('max_lines', '>', 0),
+            ],
+        help='Split the selected lines in several balanced moves with at '
+        'most this number of lines.')
 
     @staticmethod
     def default_date():
@@ -508,11 +1550,19 @@ class CompensationMoveStart(ModelView, BankMixin):
         pool = Pool()
         return pool.get('ir.date').today()
 
+    @staticmethod
+    def default_max_lines():
+        return config.getint(
+            'account_bank', 'compensation_move_max_lines', default=0) or None
+
     @classmethod
     def default_get(
             cls, fields_names=None, with_rec_name=True, with_default=True):
         pool = Pool()
+        Account = pool.get('account.account')
+        Company = pool.get('company.company')
         Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
         PaymentType = pool.get('account.payment.type')
 
         defaults = super().default_get(
@@ -520,23 +1570,57 @@ class CompensationMoveStart(ModelView, BankMixin):
             with_rec_name=with_rec_name,
             with_default=with_default)
 
-        party = None
-        company = None
-        amount = Decimal(0)
+        move_line = Line.__table__()
+        account = Account.__table__()
+        cursor = Transaction().connection.cursor()
 
-        lines = Line.browse(Transaction().context.get('active_ids', []))
-        for line in lines:
-            amount += line.debit - line.credit
-            if not party:
-                party = line.party
-            elif party != line.party:
-                raise UserError(gettext('account_bank.different_parties',
-                        party=line.party.rec_name, line=line.rec_name,
-                        previous_party=party.rec_name))
-            if not company:
-                company = line.account.company
+        # The extremes of each slice are enough to know if the lines have
+        # different parties or accounts and the counts if some lines have no
+        # party
+        amount = Decimal(0)
+        parties, accounts, companies = set(), set(), set()
+        without_party = False
+        active_ids = Transaction().context.get('active_ids', [])
+        for sub_ids in grouped_slice(active_ids, backend.MAX_QUERY_PARAMS):
+            query = move_line.join(account, condition=(
+                    account.id == move_line.account)).select(
+                Sum(move_line.debit - move_line.credit).as_('amount'),
+                Min(move_line.party), Max(move_line.party),
+                Count(move_line.party), Count(Literal('*')),
+                Min(move_line.account), Max(move_line.account),
+                Min(account.company),
+                where=fields.SQL_OPERATORS['in'](move_line.id, list(sub_ids)))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, ['NUMERIC'])
+            cursor.execute(*query)
+            (sub_amount, min_party, max_party, party_count, count,
+                min_account, max_account, company_id) = cursor.fetchone()
+            if sub_amount is None:
+                continue
+            amount += sub_amount
+            parties.update(p for p in (min_party, max_party) if p is not None)
+            without_party |= party_count != count
+            accounts.update((min_account, max_account))
+            companies.add(company_id)
+
+        if len(parties) > 1 or (parties and without_party):
+            previous_party = Party(min(parties))
+            if len(parties) > 1:
+                party_domain = ('party', '=', max(parties))
+            else:
+                party_domain = ('party', '=', None)
+            line, = Line.search([
+                    ('id', 'in', active_ids),
+                    party_domain,
+                    ], limit=1)
+            raise UserError(gettext('account_bank.different_parties',
+                    party=line.party.rec_name if line.party else '',
+                    line=line.rec_name,
+                    previous_party=previous_party.rec_name))
+        party = Party(parties.pop()) if parties else None
+        company = Company(min(companies)) if companies else None
         if (company and company.currency.is_zero(amount)
-                and len(set([x.account for x in lines])) == 1):
+                and len(accounts) == 1):
             raise UserError(gettext('account_bank.normal_reconcile'))
         if amount > 0:
             defaults['payment_kind'] = 'receivable'
@@ -558,7 +1642,7 @@ class CompensationMoveStart(ModelView, BankMixin):
                 self = cls()
                 self.payment_type = payment_type
                 self.party = party
-                self._get_bank_account()
+                cls._get_bank_accounts([self])
                 defaults['account_bank_from'] = (
                     self.on_change_with_account_bank_from())
                 defaults['bank_account'] = (self.bank_account.id
@@ -585,50 +1669,44 @@ class CompensationMove(Wizard):
             ])
     create_move = StateTransition()
 
+    @instrumented
     def transition_create_move(self):
         pool = Pool()
-        Move = pool.get('account.move')
         Line = pool.get('account.move.line')
 
-        move_lines = []
-        lines = Line.browse(Transaction().context.get('active_ids'))
-
-        for line in lines:
-            if ((line.account.type.receivable == False and
-                    line.account.type.payable == False)
-                    or line.reconciliation):
+        # Big selections can be split in several balanced moves which are
+        # posted before reading the lines of the next one
+        active_ids = Transaction().context.get('active_ids') or []
+        size = self.start.max_lines or len(active_ids)
+        for sub_ids in grouped_slice(active_ids, size):
+            lines = Line.browse(list(sub_ids))
+            move_lines = []
+            for line in lines:
+                if ((line.account.type.receivable == False and
+                        line.account.type.payable == False)
+                        or line.reconciliation):
+                    continue
+                move_lines.append(self.get_counterpart_line(line))
+
+            if not lines or not move_lines:
                 continue
-            move_lines.append(self.get_counterpart_line(line))
 
-        if not lines or not move_lines:
-            return 'end'
+            move = self.get_move(lines)
+            extra_lines, origin = self.get_extra_lines(lines,
+                self.start.account, self.start.party)
 
-        move = self.get_move(lines)
-        extra_lines, origin = self.get_extra_lines(lines, self.start.account,
-            self.start.party)
-
-        if origin:
-            move.origin = origin
-        move.lines = move_lines + extra_lines
-        move.save()
-        Move.post([move])
-        to_reconcile = {}
-        for line in lines:
-            to_reconcile.setdefault(line.account.id, []).append(line)
-        for line in move.lines:
-            append = True
-            for extra_line in extra_lines:
-                if self.is_extra_line(line, extra_line):
-                    append = False
-                    break
-            if append:
-                to_reconcile.setdefault(line.account.id, []).append(line)
-        for lines_to_reconcile in to_reconcile.values():
-            Line.reconcile(lines_to_reconcile)
+            if origin:
+                move.origin = origin
+            Line._post_compensation_moves(
+                [(move, lines, move_lines, extra_lines)])
         return 'end'
 
     def is_extra_line(self, line, extra_line):
         " Returns true if both lines are equal"
+        warnings.warn(
+            "is_extra_line is deprecated, the counterpart lines are "
+            "reconciled without being compared with the extra lines",
+            DeprecationWarning, stacklevel=2)
         return (line.debit == extra_line.debit and
             line.credit == extra_line.credit and
             line.maturity_date == extra_line.maturity_date and
@@ -639,18 +1717,7 @@ class CompensationMove(Wizard):
         'Returns the counterpart line to create from line'
         pool = Pool()
         Line = pool.get('account.move.line')
-
-        new_line = Line()
-        new_line.account = line.account
-        new_line.debit = line.credit
-        new_line.credit = line.debit
-        new_line.description = line.description
-        new_line.second_currency = line.second_currency
-        if line.second_currency:
-            new_line.amount_second_currency = -line.amount_second_currency
-        new_line.party = line.party
-
-        return new_line
+        return Line.get_compensation_line(line)
 
     def get_move(self, lines):
         'Returns the new move to create from lines'
@@ -707,3 +1774,62 @@ class CompensationMove(Wizard):
                 origin = line_origin
                 break
         return [extra_line], origin
+
+
+class CompensationMoveBatchStart(ModelView):
+    'Create Compensation Moves Start'
+    __name__ = 'account.move.compensation_move.batch.start'
+    date = fields.Date('Date', required=True)
+    maturity_date = fields.Date('Maturity Date')
+    description = fields.Char('Description')
+    background = fields.Boolean('Background',
+        help='Create the move of each party in its own background task.')
+
+    @staticmethod
+    def default_date():
+        pool = Pool()
+        return pool.get('ir.date').today()
+
+    @staticmethod
+    def default_maturity_date():
+        pool = Pool()
+        return pool.get('ir.date').today()
+
+
+class CompensationMoveBatch(Wizard):
+    'Create Compensation Moves'
+    __name__ = 'account.move.compensation_move.batch'
+    start = StateView('account.move.compensation_move.batch.start',
+        'account_bank.compensation_move_batch_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'create_moves', 'tryton-ok', default=True),
+            ])
+    create_moves = StateTransition()
+
+    @instrumented
+    def transition_create_moves(self):
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Rule = pool.get('ir.rule')
+
+        # Without selection compensate all the parties with netting moves one
+        # party at a time
+        active_ids = Transaction().context.get('active_ids')
+        if active_ids:
+            groups = Line._get_compensation_groups(
+                Line.browse(active_ids)).values()
+        else:
+            companies = Rule._get_context(Line.__name__).get('companies')
+            groups = (Line.browse(ids) for _, _, ids
+                in Line._get_netting_line_ids(companies or [-1]))
+        kwargs = {
+            'date': self.start.date,
+            'maturity_date': self.start.maturity_date,
+            'description': self.start.description,
+            }
+        for lines in groups:
+            if self.start.background:
+                Line.__queue__.compensate(lines, **kwargs)
+            else:
+                Line.compensate(lines, **kwargs)
+        return 'end'
@@ -0,0 +1,197 @@
+# This file is part of account_bank module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+import time
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrumented', 'get_summary', 'reset_summary', 'QueryCounter']
+
+logger = logging.getLogger(__name__)
+backend_logger = logging.getLogger('trytond.backend')
+
+_summary = {}
+_summary_lock = threading.Lock()
+_local = threading.local()
+
+
+class QueryCounter(logging.Handler):
+    '''
+    Counts the queries logged by the backends and the rows fetched by the
+    cursors of the transaction in the current thread while it is entered.
+    The rows are only counted by the backends whose connection has a
+    cursor_factory (PostgreSQL), otherwise rows is None.
+    '''
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.thread = threading.get_ident()
+        self.count = 0
+        self.rows = None
+        self._connection = None
+        self._cursor_factory = None
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.count += 1
+
+    def __enter__(self):
+        backend_logger.addHandler(self)
+        connection = Transaction().connection
+        factory = getattr(connection, 'cursor_factory', None)
+        if factory is not None:
+            self.rows = 0
+            if not issubclass(factory, _RowCountingCursor):
+                connection.cursor_factory = _row_counting_cursor(factory)
+                self._connection = connection
+                self._cursor_factory = factory
+            _counters().append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        backend_logger.removeHandler(self)
+        if self.rows is not None:
+            _counters().remove(self)
+        if self._connection is not None:
+            self._connection.cursor_factory = self._cursor_factory
+            self._connection = self._cursor_factory = None
+
+
+def _counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+    return _local.counters
+
+
+def _add_rows(count):
+    for counter in _counters():
+        counter.rows += count
+
+
+class _RowCountingCursor(object):
+    "Adds the fetched rows to the active query counters"
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _add_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in super().__iter__():
+            _add_rows(1)
+            yield row
+
+
+_row_counting_cursors = {}
+
+
+def _row_counting_cursor(factory):
+    if factory not in _row_counting_cursors:
+        _row_counting_cursors[factory] = type(
+            'RowCounting' + factory.__name__,
+            (_RowCountingCursor, factory), {})
+    return _row_counting_cursors[factory]
+
+
+def is_enabled():
+    '''
+    Returns if the instrumentation is enabled by the account_bank
+    instrumentation option of the configuration or by the context.
+    '''
+    context = Transaction().context
+    if 'account_bank_instrumentation' in context:
+        return bool(context['account_bank_instrumentation'])
+    return config.getboolean(
+        'account_bank', 'instrumentation', default=False)
+
+
+def instrumented(func):
+    '''
+    Records the calls, elapsed time, number of records, number of queries and
+    number of rows fetched of func when the instrumentation is enabled.
+    The queries are only counted when the backends log them, which is when
+    trytond.backend logs at debug level, and the rows only on the backends
+    supported by QueryCounter.
+    '''
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_enabled():
+            return func(*args, **kwargs)
+        records = _count_records(func, args)
+        logged = backend_logger.isEnabledFor(logging.DEBUG)
+        start = time.perf_counter()
+        with QueryCounter() as counter:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                _record(name, seconds, records,
+                    counter.count if logged else None, counter.rows)
+    return wrapper
+
+
+def _count_records(func, args):
+    '''
+    Returns the number of records of the lists passed after the class or the
+    instance, which alternate with the values for write.
+    '''
+    lists = args[1::2] if func.__name__ == 'write' else args[1:2]
+    lists = [l for l in lists if isinstance(l, (list, tuple))]
+    if lists:
+        return sum(len(l) for l in lists)
+
+
+def _record(name, seconds, records, queries, rows):
+    data = {
+        'name': name,
+        'seconds': seconds,
+        'records': records,
+        'queries': queries,
+        'rows': rows,
+        }
+    logger.info(
+        "%s: %.6fs, %s records, %s queries, %s rows",
+        name, seconds, records, queries, rows,
+        extra={'account_bank': data})
+    with _summary_lock:
+        summary = _summary.setdefault(name, {
+                'calls': 0,
+                'seconds': 0.0,
+                'records': 0,
+                'queries': 0,
+                'rows': 0,
+                })
+        summary['calls'] += 1
+        summary['seconds'] += seconds
+        summary['records'] += records or 0
+        summary['queries'] += queries or 0
+        summary['rows'] += rows or 0
+
+
+def get_summary():
+    'Returns the totals recorded for each instrumented method'
+    with _summary_lock:
+        return {n: s.copy() for n, s in _summary.items()}
+
+
+def reset_summary():
+    'Clears the recorded totals'
+    with _summary_lock:
+        _summary.clear()
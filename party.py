@@ -1,7 +1,10 @@
 # This file is part of account_bank module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .instrumentation import instrumented
 
 __all__ = ['PartyReplace']
 
@@ -15,3 +18,53 @@ class PartyReplace(metaclass=PoolMeta):
             ('account.payment.type', 'party'),
             ('account.payment.journal', 'party'),
             ]
+
+    @instrumented
+    def transition_replace(self):
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
+        OpenBalance = pool.get('account.move.line.open_balance')
+        source = self.ask.source
+        destination = self.ask.destination
+
+        self._merge_bank_account_owners(source, destination)
+        state = super(PartyReplace, self).transition_replace()
+        # The owners follow the party so the violations of the records using
+        # the accounts of the destination are recorded instead of raised
+        BankAccount._record_or_queue_owners_violations(BankAccount.browse(
+                self._get_owned_bank_accounts(destination)))
+        # The lines of the destination are updated by on_modification but
+        # the balances of the source still count them
+        OpenBalance.refresh_parties([source])
+        return state
+
+    @classmethod
+    def _merge_bank_account_owners(cls, source, destination):
+        '''
+        Removes the source from the owners of the bank accounts that the
+        destination already owns so replacing the owner does not duplicate
+        them.
+        '''
+        pool = Pool()
+        AccountParty = pool.get('bank.account-party.party')
+        account_party = AccountParty.__table__()
+        owned = AccountParty.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*account_party.delete(
+                where=(account_party.owner == source.id)
+                & account_party.account.in_(owned.select(owned.account,
+                        where=owned.owner == destination.id))))
+
+    @classmethod
+    def _get_owned_bank_accounts(cls, party):
+        'Returns the ids of the bank accounts owned by the party'
+        pool = Pool()
+        AccountParty = pool.get('bank.account-party.party')
+        account_party = AccountParty.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*account_party.select(account_party.account,
+                where=account_party.owner == party.id,
+                group_by=account_party.account))
+        return [a for a, in cursor]
@@ -1,13 +1,21 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
 
+from sql import Null
+
+from trytond import backend
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, If
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
+
+from .instrumentation import instrumented
+
 __all__ = ['Journal', 'Group', 'Payment', 'PayLine']
 
 _ZERO = Decimal(0)
@@ -31,9 +39,9 @@ class Group(metaclass=PoolMeta):
 
     payment_type = fields.Function(fields.Many2One('account.payment.type',
             'Payment Type'),
-        'on_change_with_payment_type')
+        'get_journal_fields', searcher='search_journal_field')
     currency = fields.Function(fields.Many2One('currency.currency', 'Currency'),
-        'on_change_with_currency')
+        'get_journal_fields', searcher='search_journal_field')
 
     @fields.depends('journal')
     def on_change_with_payment_type(self, name=None):
@@ -45,6 +53,31 @@ class Group(metaclass=PoolMeta):
         if self.journal and self.journal.currency:
             return self.journal.currency.id
 
+    @classmethod
+    def get_journal_fields(cls, groups, names):
+        pool = Pool()
+        Journal = pool.get('account.payment.journal')
+        group = cls.__table__()
+        journal = Journal.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = list(map(int, groups))
+        result = {n: dict.fromkeys(ids) for n in names}
+        columns = [getattr(journal, n) for n in names]
+        for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*group.join(journal, condition=(
+                        journal.id == group.journal)).select(
+                    group.id, *columns,
+                    where=fields.SQL_OPERATORS['in'](group.id, sub_ids)))
+            for group_id, *values in cursor:
+                for name, value in zip(names, values):
+                    result[name][group_id] = value
+        return result
+
+    @classmethod
+    def search_journal_field(cls, name, clause):
+        return [('journal.' + clause[0],) + tuple(clause[1:])]
+
 
 class Payment(metaclass=PoolMeta):
     __name__ = 'account.payment'
@@ -52,7 +85,7 @@ class Payment(metaclass=PoolMeta):
             'Account Bank From', context={
                 'company': Eval('company', -1),
             }, depends=['company']),
-        'on_change_with_account_bank_from')
+        'get_account_bank_from')
     bank_account = fields.Many2One('bank.account', 'Bank Account',
         states={
             'readonly': Eval('state') != 'draft',
@@ -69,19 +102,27 @@ class Payment(metaclass=PoolMeta):
         '''
         Sets the party where get bank account for this account payment.
         '''
-        Company = Pool().get('company.company')
+        PaymentType = Pool().get('account.payment.type')
 
         if self.journal and self.journal.payment_type and self.party:
-            payment_type = self.journal.payment_type
-            party = self.party
-            if payment_type.account_bank == 'party':
-                return party.id
-            elif payment_type.account_bank == 'company':
-                company_id = Transaction().context.get('company')
-                if company_id is not None and company_id >= 0:
-                    return Company(company_id).party.id
-            elif payment_type.account_bank == 'other':
-                return payment_type.party.id
+            return PaymentType.get_account_bank_from(
+                self.journal.payment_type.id, self.party.id,
+                Transaction().context.get('company'))
+
+    @classmethod
+    def get_account_bank_from(cls, payments, name):
+        PaymentType = Pool().get('account.payment.type')
+
+        company_id = Transaction().context.get('company')
+        result = {}
+        for payment in payments:
+            result[payment.id] = None
+            if (payment.journal and payment.journal.payment_type
+                    and payment.party):
+                result[payment.id] = PaymentType.get_account_bank_from(
+                    payment.journal.payment_type.id, payment.party.id,
+                    company_id)
+        return result
 
     @classmethod
     def __setup__(cls):
@@ -94,54 +135,188 @@ class Payment(metaclass=PoolMeta):
                 'readonly': readonly,
                 })
 
-    @fields.depends('party', 'kind')
+    @classmethod
+    @instrumented
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        cls._set_default_bank_accounts(vlist)
+        return super(Payment, cls).create(vlist)
+
+    @classmethod
+    def _set_default_bank_accounts(cls, vlist):
+        '''
+        Fills the bank account of the values without one with the default bank
+        account of their payment type, party, kind and company.
+        '''
+        pool = Pool()
+        Journal = pool.get('account.payment.journal')
+
+        to_fill = [v for v in vlist
+            if not v.get('bank_account') and v.get('party')
+            and v.get('journal')]
+        journals = Journal.browse(list({v['journal'] for v in to_fill}))
+        payment_types = {j.id: j.payment_type for j in journals}
+
+        keys = []
+        for values in to_fill:
+            payment_type = payment_types[values['journal']]
+            keys.append((
+                    payment_type.id if payment_type else None,
+                    values['party'],
+                    values.get('kind', cls.default_kind()),
+                    values.get('company', cls.default_company())))
+        defaults = cls._get_default_bank_accounts(keys)
+        for values, key in zip(to_fill, keys):
+            if defaults[key]:
+                values['bank_account'] = defaults[key]
+
+    @classmethod
+    def _get_default_bank_accounts(cls, keys):
+        '''
+        Returns the default bank account id for each key of payment type id,
+        party id, kind and company id.
+        The bank account is taken from the payment type like
+        BankMixin._get_bank_account and the parties of each company and field
+        are read at once.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        PaymentType = pool.get('account.payment.type')
+
+        result = dict.fromkeys(keys)
+        payment_types = {p.id: p for p in PaymentType.browse(
+                list({k[0] for k in result if k[0] is not None}))}
+
+        # The fields of the parties to read in order of preference
+        candidates = {}
+        to_read = defaultdict(set)
+        for key in result:
+            payment_type_id, party_id, kind, company_id = key
+            if payment_type_id is None or not party_id or not kind:
+                continue
+            payment_type = payment_types[payment_type_id]
+            if payment_type.account_bank == 'other':
+                if payment_type.bank_account:
+                    result[key] = payment_type.bank_account.id
+                continue
+            elif payment_type.account_bank == 'party':
+                owners = [(kind + '_bank_account', party_id)]
+            elif payment_type.account_bank == 'company':
+                owners = [(kind + '_company_bank_account', party_id)]
+                if company_id is not None and company_id >= 0:
+                    owners.append((kind + '_bank_account',
+                            Company(company_id).party.id))
+            else:
+                continue
+            owners = [(f, p) for f, p in owners if f in Party._fields]
+            for fname, owner_id in owners:
+                to_read[(company_id, fname)].add(owner_id)
+            candidates[key] = owners
+
+        values = {}
+        for (company_id, fname), party_ids in to_read.items():
+            context = {}
+            if company_id is not None:
+                context['company'] = company_id
+            with Transaction().set_context(**context):
+                for party in Party.read(list(party_ids), [fname]):
+                    values[(company_id, fname, party['id'])] = party[fname]
+
+        for key, owners in candidates.items():
+            company_id = key[3]
+            for fname, owner_id in owners:
+                bank_account = values.get((company_id, fname, owner_id))
+                if bank_account:
+                    result[key] = bank_account
+                    break
+        return result
+
+    @fields.depends('journal', 'party', 'kind', 'company')
+    def _get_default_bank_account(self):
+        'Returns the default bank account of the payment'
+        BankAccount = Pool().get('bank.account')
+        payment_type = self.journal.payment_type if self.journal else None
+        key = (
+            payment_type.id if payment_type else None,
+            self.party.id if self.party else None,
+            self.kind,
+            self.company.id if self.company else None)
+        bank_account = self._get_default_bank_accounts([key])[key]
+        if bank_account:
+            return BankAccount(bank_account)
+
+    @fields.depends(methods=['_get_default_bank_account'])
     def on_change_kind(self):
         super(Payment, self).on_change_kind()
-        self.bank_account = None
-        party = self.party
-        if self.kind and party:
-            default_bank_account = getattr(party, self.kind + '_bank_account')
-            self.bank_account = (default_bank_account and
-                default_bank_account.id or None)
-
-    @fields.depends('party', 'kind')
+        self.bank_account = self._get_default_bank_account()
+
+    @fields.depends(methods=['_get_default_bank_account'])
     def on_change_party(self):
         super(Payment, self).on_change_party()
-        self.bank_account = None
-        party = self.party
-        if party and self.kind:
-            default_bank_account = getattr(party, self.kind + '_bank_account')
-            self.bank_account = (default_bank_account and
-                default_bank_account.id or None)
-
-    @fields.depends('party', 'line', 'kind')
+        self.bank_account = self._get_default_bank_account()
+
+    @fields.depends(methods=['_get_default_bank_account'])
     def on_change_line(self):
         super(Payment, self).on_change_line()
-        self.bank_account = None
-        party = self.party
-        if self.party and self.kind:
-            default_bank_account = getattr(party, self.kind + '_bank_account')
-            self.bank_account = (default_bank_account and
-                default_bank_account.id or None)
+        self.bank_account = self._get_default_bank_account()
 
     @classmethod
+    def _get_valid_sepa_mandates(cls, payments):
+        '''
+        Returns the first valid mandate of each party and bank account of the
+        payments.
+        '''
+        pool = Pool()
+        Mandate = pool.get('account.payment.sepa.mandate')
+
+        parties = {p.party.id for p in payments if p.party}
+        bank_accounts = {p.bank_account.id for p in payments if p.bank_account}
+        mandates = {}
+        for sub_parties in grouped_slice(
+                list(parties), backend.MAX_QUERY_PARAMS // 2):
+            for sub_accounts in grouped_slice(
+                    list(bank_accounts), backend.MAX_QUERY_PARAMS // 2):
+                for mandate in Mandate.search([
+                            ('party', 'in', list(sub_parties)),
+                            ('account_number.account', 'in',
+                                list(sub_accounts)),
+                            ('state', '=', 'validated'),
+                            ]):
+                    if mandate.is_valid:
+                        mandates.setdefault((mandate.party.id,
+                                mandate.account_number.account.id), mandate)
+        return mandates
+
+    @classmethod
+    @instrumented
     def get_sepa_mandates(cls, payments):
         mandates = super(Payment, cls).get_sepa_mandates(payments)
+
+        missing = [p for p, m in zip(payments, mandates) if not m]
+        if len(missing) == 1:
+            payment, = missing
+            raise UserError(gettext('account_bank.no_mandate_for_party',
+                    payment=payment.rec_name,
+                    party=payment.party.rec_name,
+                    amount=payment.amount))
+        elif missing:
+            names = ', '.join('%s (%s)' % (p.rec_name, p.party.rec_name)
+                for p in missing[:5])
+            if len(missing) > 5:
+                names += '...'
+            raise UserError(gettext('account_bank.no_mandate_for_parties',
+                    payments=names))
+
+        to_check = [p for p, m in zip(payments, mandates)
+            if p.bank_account != m.account_number.account]
+        valid_mandates = cls._get_valid_sepa_mandates(to_check)
         mandates2 = []
         for payment, mandate in zip(payments, mandates):
-            if not mandate:
-                raise UserError(gettext('account_bank.no_mandate_for_party',
-                        payment=payment.rec_name,
-                        party=payment.party.rec_name,
-                        amount=payment.amount))
             if payment.bank_account != mandate.account_number.account:
-                mandate = None
-                for mandate2 in payment.party.sepa_mandates:
-                    if (mandate2.is_valid and
-                        mandate2.account_number.account == payment.bank_account
-                        ):
-                        mandate = mandate2
-                        break
+                mandate = valid_mandates.get((payment.party.id,
+                        payment.bank_account.id if payment.bank_account
+                        else None))
             mandates2.append(mandate)
         return mandates2
 
@@ -149,12 +324,58 @@ class Payment(metaclass=PoolMeta):
 class PayLine(metaclass=PoolMeta):
     __name__ = 'account.move.line.pay'
 
-    def get_payment(self, line, journals):
+    def _get_lines_bank_account_ids(self, lines):
+        '''
+        Returns the bank account id to pay each line id with, taken from the
+        line or, as a fallback, from its invoice.
+        '''
         pool = Pool()
+        Line = pool.get('account.move.line')
         Invoice = pool.get('account.invoice')
+        line = Line.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        bank_accounts, invoices = {}, {}
+        for sub_ids in grouped_slice(
+                list(map(int, lines)), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.select(
+                    line.id, line.bank_account, line.origin,
+                    where=fields.SQL_OPERATORS['in'](line.id, sub_ids)))
+            for line_id, bank_account_id, origin in cursor:
+                if bank_account_id:
+                    bank_accounts[line_id] = bank_account_id
+                elif origin and origin.startswith(Invoice.__name__ + ','):
+                    invoices[line_id] = int(origin.split(',', 1)[1])
+
+        invoice_bank_accounts = {}
+        for sub_ids in grouped_slice(
+                list(set(invoices.values())), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*invoice.select(invoice.id, invoice.bank_account,
+                    where=(fields.SQL_OPERATORS['in'](invoice.id, sub_ids)
+                        & (invoice.bank_account != Null))))
+            invoice_bank_accounts.update(cursor)
+        for line_id, invoice_id in invoices.items():
+            if invoice_id in invoice_bank_accounts:
+                bank_accounts[line_id] = invoice_bank_accounts[invoice_id]
+        return bank_accounts
+
+    def get_payment(self, line, journals):
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
         payment = super(PayLine, self).get_payment(line, journals)
-        if hasattr(line, 'bank_account') and line.bank_account:
-            payment.bank_account = line.bank_account
-        elif isinstance(line.origin, Invoice):
-            payment.bank_account = line.origin.bank_account
+        bank_accounts = getattr(self, '_lines_bank_account_ids', None)
+        if bank_accounts is None:
+            bank_accounts = self._get_lines_bank_account_ids([line])
+        bank_account_id = bank_accounts.get(line.id)
+        if bank_account_id:
+            payment.bank_account = BankAccount(bank_account_id)
         return payment
+
+    @instrumented
+    def do_pay(self, action):
+        # Read the bank accounts of all the lines at once instead of loading
+        # the invoice of each line
+        self._lines_bank_account_ids = self._get_lines_bank_account_ids(
+            self.records)
+        return super().do_pay(action)
@@ -0,0 +1,384 @@
+# This file is part of account_bank module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmark of the account_bank hot paths.
+
+It builds a synthetic database with parties, bank accounts and posted move
+lines and reports the wall time, the number of SQL queries and the number of
+rows fetched (only on PostgreSQL) of each benchmark as JSON. The database is
+configured like the tests with TRYTOND_DATABASE_URI and DB_NAME:
+
+    python -m trytond.modules.account_bank.tests.benchmark \\
+        --lines 100000 --parties 1000 --output benchmark.json
+
+Each benchmark runs in its own transaction which is rolled back so the runs
+can be compared.
+'''
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+import time
+from decimal import Decimal
+
+from trytond import backend
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_bank.instrumentation import QueryCounter
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+
+def setup(lines, parties, batch=1000):
+    'Creates the synthetic data and returns the company id'
+    pool = Pool()
+    Account = pool.get('account.account')
+    Bank = pool.get('bank')
+    BankAccount = pool.get('bank.account')
+    FiscalYear = pool.get('account.fiscalyear')
+    Journal = pool.get('account.journal')
+    Move = pool.get('account.move')
+    Party = pool.get('party.party')
+    PaymentJournal = pool.get('account.payment.journal')
+    PaymentType = pool.get('account.payment.type')
+    Period = pool.get('account.period')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company)
+        fiscalyear = get_fiscalyear(company)
+        set_invoice_sequences(fiscalyear)
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        payable, = Account.search([
+                ('type.payable', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+
+        receivable_type, payable_type = PaymentType.create([{
+                    'name': 'Receivable',
+                    'kind': 'receivable',
+                    'account_bank': 'party',
+                    'company': company.id,
+                    }, {
+                    'name': 'Payable',
+                    'kind': 'payable',
+                    'account_bank': 'party',
+                    'company': company.id,
+                    }])
+        PaymentJournal.create([{
+                    'name': 'Manual',
+                    'process_method': 'manual',
+                    'currency': company.currency.id,
+                    'company': company.id,
+                    'payment_type': receivable_type.id,
+                    }])
+
+        bank = Bank(party=Party(name='Bank'))
+        bank.party.save()
+        bank.save()
+        party_records = Party.create([{
+                    'name': 'Party %s' % i,
+                    'customer_payment_type': receivable_type.id,
+                    'supplier_payment_type': payable_type.id,
+                    } for i in range(parties)])
+        BankAccount.create([{
+                    'bank': bank.id,
+                    'numbers': [('create', [{
+                                    'type': 'other',
+                                    'number': 'ACCOUNT%08d' % party.id,
+                                    }])],
+                    'owners': [('add', [party.id])],
+                    } for party in party_records])
+
+        # Each move has a receivable debit or a payable credit for a party so
+        # every party has netting and reverse moves
+        period = Period.find(company, date=datetime.date.today())
+        moves = []
+        for i in range(lines // 2):
+            party = party_records[i % parties]
+            amount = Decimal(10 + i % 90)
+            if i % 2:
+                line = {
+                    'account': payable.id,
+                    'payment_type': payable_type.id,
+                    'credit': amount,
+                    'debit': Decimal(0),
+                    }
+                counterpart = {'debit': amount, 'credit': Decimal(0)}
+            else:
+                line = {
+                    'account': receivable.id,
+                    'payment_type': receivable_type.id,
+                    'debit': amount,
+                    'credit': Decimal(0),
+                    }
+                counterpart = {'credit': amount, 'debit': Decimal(0)}
+            line['party'] = party.id
+            line['maturity_date'] = datetime.date.today()
+            counterpart['account'] = revenue.id
+            moves.append({
+                    'company': company.id,
+                    'journal': journal.id,
+                    'period': period.id,
+                    'date': datetime.date.today(),
+                    'lines': [('create', [line, counterpart])],
+                    })
+        for sub_moves in grouped_slice(moves, batch):
+            Move.post(Move.create(list(sub_moves)))
+        return company.id
+
+
+def create_invoices(company, count, payment_term=None):
+    'Returns new draft customer invoices'
+    pool = Pool()
+    Account = pool.get('account.account')
+    Invoice = pool.get('account.invoice')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    parties = Party.search([('customer_payment_type', '!=', None)])
+    return Invoice.create([{
+                'type': 'out',
+                'company': company.id,
+                'currency': company.currency.id,
+                'journal': journal.id,
+                'party': party.id,
+                'invoice_address': party.address_get().id,
+                'account': receivable.id,
+                'payment_type': party.customer_payment_type.id,
+                'invoice_date': datetime.date.today(),
+                'payment_term': payment_term.id if payment_term else None,
+                'lines': [('create', [{
+                                'type': 'line',
+                                'company': company.id,
+                                'currency': company.currency.id,
+                                'account': revenue.id,
+                                'description': 'Benchmark',
+                                'quantity': 1,
+                                'unit_price': Decimal(100),
+                                }])],
+                } for party in (parties[i % len(parties)]
+                for i in range(count))])
+
+
+# Each benchmark prepares its data and returns the function to time, which
+# returns the number of processed records
+
+
+def bench_search_reverse_moves(company, size):
+    Line = Pool().get('account.move.line')
+    return lambda: len(Line.search([('reverse_moves', '=', True)]))
+
+
+def bench_search_netting_moves(company, size):
+    Line = Pool().get('account.move.line')
+    return lambda: len(Line.search([('netting_moves', '=', True)]))
+
+
+def bench_invoice_post(company, size):
+    Invoice = Pool().get('account.invoice')
+    invoices = create_invoices(company, size)
+
+    def post():
+        Invoice.post(invoices)
+        return len(invoices)
+    return post
+
+
+def create_installments_payment_term(installments):
+    'Returns a payment term with monthly installments'
+    pool = Pool()
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    PaymentTermLine = pool.get('account.invoice.payment_term.line')
+    Delta = pool.get('account.invoice.payment_term.line.delta')
+
+    lines = []
+    for month in range(installments):
+        line = PaymentTermLine(relativedeltas=[Delta(months=month)])
+        if month < installments - 1:
+            line.type = 'percent_on_total'
+            line.divisor = Decimal(installments)
+            line.on_change_divisor()
+        else:
+            line.type = 'remainder'
+        lines.append(line)
+    payment_term = PaymentTerm(
+        name='%s installments' % installments, lines=lines)
+    payment_term.save()
+    return payment_term
+
+
+def bench_invoice_post_installments(company, size):
+    Invoice = Pool().get('account.invoice')
+    invoices = create_invoices(company, size,
+        payment_term=create_installments_payment_term(12))
+
+    def post():
+        Invoice.post(invoices)
+        return len(invoices)
+    return post
+
+
+def bench_check_owners(company, size):
+    BankAccount = Pool().get('bank.account')
+    accounts = BankAccount.search([])
+
+    def check_owners():
+        BankAccount.check_owners(accounts)
+        return len(accounts)
+    return check_owners
+
+
+def bench_compensation_move(company, size):
+    Line = Pool().get('account.move.line')
+    lines = Line.search([
+            ('netting_moves', '=', True),
+            ('reconciliation', '=', None),
+            ], limit=size)
+    return lambda: len(Line.compensate(lines))
+
+
+def bench_pay_line(company, size):
+    pool = Pool()
+    Line = pool.get('account.move.line')
+    PaymentJournal = pool.get('account.payment.journal')
+    PayLine = pool.get('account.move.line.pay', type='wizard')
+
+    lines = Line.search([
+            ('account.type.receivable', '=', True),
+            ('reconciliation', '=', None),
+            ('move_state', '=', 'posted'),
+            ], limit=size)
+    journal, = PaymentJournal.search([], limit=1)
+    context = {
+        'active_model': Line.__name__,
+        'active_ids': [l.id for l in lines],
+        'active_id': lines[0].id if lines else None,
+        }
+    with Transaction().set_context(**context):
+        session_id, _, _ = PayLine.create()
+
+    def pay():
+        with Transaction().set_context(**context):
+            pay_line = PayLine(session_id)
+            pay_line.start.date = None
+            pay_line.ask_journal.journal = journal
+            pay_line.ask_journal.journals = [journal]
+            pay_line.do_pay(None)
+        return len(lines)
+    return pay
+
+
+BENCHMARKS = [
+    ('search_reverse_moves', bench_search_reverse_moves),
+    ('search_netting_moves', bench_search_netting_moves),
+    ('invoice_post', bench_invoice_post),
+    ('invoice_post_installments', bench_invoice_post_installments),
+    ('check_owners', bench_check_owners),
+    ('compensation_move', bench_compensation_move),
+    ('pay_line', bench_pay_line),
+    ]
+
+
+def run(company_id, size, names=None):
+    'Runs the benchmarks and returns their results'
+    results = []
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        with Transaction().start(DB_NAME, USER) as transaction:
+            pool = Pool()
+            Company = pool.get('company.company')
+            company = Company(company_id)
+            with set_company(company):
+                benchmark = func(company, size)
+                with QueryCounter() as counter:
+                    start = time.perf_counter()
+                    records = benchmark()
+                    elapsed = time.perf_counter() - start
+            transaction.rollback()
+        results.append({
+                'name': name,
+                'seconds': elapsed,
+                'queries': counter.count,
+                'rows': counter.rows,
+                'records': records,
+                })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=10000,
+        help="number of move lines to create")
+    parser.add_argument('--parties', type=int, default=100,
+        help="number of parties to create")
+    parser.add_argument('--size', type=int, default=1000,
+        help="number of records processed by the write benchmarks")
+    parser.add_argument('--output', default='-',
+        help="file to write the JSON results to")
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+        help="benchmarks to run among %s, all by default" % ', '.join(
+            n for n, _ in BENCHMARKS))
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - {n for n, _ in BENCHMARKS}
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    # The backends log the queries only when debug is enabled on connection
+    logging.getLogger('trytond.backend').setLevel(logging.DEBUG)
+    logging.getLogger('trytond.backend').propagate = False
+
+    activate_module(['account_bank'])
+    with Transaction().start(DB_NAME, USER) as transaction:
+        start = time.perf_counter()
+        company_id = setup(args.lines, args.parties)
+        setup_time = time.perf_counter() - start
+        transaction.commit()
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'database': backend.name,
+        'lines': args.lines,
+        'parties': args.parties,
+        'size': args.size,
+        'setup_seconds': setup_time,
+        'results': run(company_id, args.size, args.benchmarks),
+        }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
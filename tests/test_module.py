@@ -2,13 +2,1351 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime
+from decimal import Decimal
+
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.account_bank.instrumentation import (
+    get_summary, reset_summary)
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.currency.tests import create_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_accounts(company):
+    'Creates the chart of company and returns its period and accounts'
+    pool = Pool()
+    Account = pool.get('account.account')
+    FiscalYear = pool.get('account.fiscalyear')
+    Journal = pool.get('account.journal')
+    Period = pool.get('account.period')
+
+    create_chart(company)
+    fiscalyear = get_fiscalyear(company)
+    set_invoice_sequences(fiscalyear)
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+    period = Period.find(company, date=datetime.date.today())
+    journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    payable, = Account.search([
+            ('type.payable', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    return {
+        'period': period,
+        'journal': journal,
+        'receivable': receivable,
+        'payable': payable,
+        'revenue': revenue,
+        }
+
+
+def create_move(accounts, lines, post=False):
+    '''
+    Creates a move with lines, a list of (account, party, debit, credit),
+    balanced on the revenue account and returns its lines in the same order.
+    '''
+    pool = Pool()
+    Move = pool.get('account.move')
+
+    values = []
+    for account, party, debit, credit in lines:
+        values.append({
+                'account': accounts[account].id,
+                'party': party.id if party else None,
+                'debit': Decimal(debit),
+                'credit': Decimal(credit),
+                })
+        values.append({
+                'account': accounts['revenue'].id,
+                'debit': Decimal(credit),
+                'credit': Decimal(debit),
+                })
+    period = accounts['period']
+    move, = Move.create([{
+                'company': period.company.id,
+                'period': period.id,
+                'journal': accounts['journal'].id,
+                'date': datetime.date.today(),
+                'lines': [('create', values)],
+                }])
+    if post:
+        Move.post([move])
+    # The counterparts on the revenue account are created after each line
+    return sorted(move.lines, key=lambda l: l.id)[::2]
+
+
+def create_invoice(accounts, party, payment_type, bank_account=None):
+    'Creates a draft customer invoice of party with payment_type'
+    Invoice = Pool().get('account.invoice')
+
+    company = accounts['period'].company
+    invoice, = Invoice.create([{
+                'type': 'out',
+                'company': company.id,
+                'currency': company.currency.id,
+                'journal': accounts['journal'].id,
+                'party': party.id,
+                'invoice_address': party.address_get().id,
+                'account': accounts['receivable'].id,
+                'payment_type': payment_type.id if payment_type else None,
+                'bank_account': bank_account.id if bank_account else None,
+                'invoice_date': datetime.date.today(),
+                'lines': [('create', [{
+                                'type': 'line',
+                                'company': company.id,
+                                'currency': company.currency.id,
+                                'account': accounts['revenue'].id,
+                                'description': 'Line',
+                                'quantity': 1,
+                                'unit_price': Decimal(100),
+                                }])],
+                }])
+    return invoice
+
+
+def create_bank_account(party):
+    'Creates a bank account owned by party'
+    pool = Pool()
+    Bank = pool.get('bank')
+    BankAccount = pool.get('bank.account')
+    Party = pool.get('party.party')
+
+    bank_party, = Party.create([{'name': 'Bank'}])
+    bank, = Bank.create([{'party': bank_party.id}])
+    count = BankAccount.search_count([('owners', '=', party.id)])
+    account, = BankAccount.create([{
+                'bank': bank.id,
+                'numbers': [('create', [{
+                                'type': 'other',
+                                'number': 'ACCOUNT%s-%s' % (party.id, count),
+                                }])],
+                'owners': [('add', [party.id])],
+                }])
+    return account
+
+
+def create_payment_type(company, kind, account_bank='party'):
+    'Creates a payment type of kind taking the bank account from account_bank'
+    PaymentType = Pool().get('account.payment.type')
+    payment_type, = PaymentType.create([{
+                'name': kind,
+                'kind': kind,
+                'account_bank': account_bank,
+                'company': company.id,
+                }])
+    return payment_type
+
+
+def set_config(test, section, option, value):
+    'Sets the option of the configuration for the duration of test'
+    if not config.has_section(section):
+        config.add_section(section)
+    previous = config.get(section, option)
+    config.set(section, option, value)
+    if previous is None:
+        test.addCleanup(config.remove_option, section, option)
+    else:
+        test.addCleanup(config.set, section, option, previous)
 
 
 class AccountBankTestCase(CompanyTestMixin, ModuleTestCase):
     'Test AccountBank module'
     module = 'account_bank'
+    extras = ['account_payment_sepa']
+
+    def assertSearchMatchesGetter(self, name, lines):
+        'Asserts the searcher of name agrees with its getter on lines'
+        Line = Pool().get('account.move.line')
+        ids = [l.id for l in lines]
+        getter = getattr(Line, 'get_%s' % name)(lines, name)
+        with_true = Line.search([('id', 'in', ids), (name, '=', True)])
+        with_false = Line.search([('id', 'in', ids), (name, '=', False)])
+        self.assertEqual(
+            {l.id for l in with_true}, {i for i in ids if getter[i]})
+        self.assertEqual(
+            {l.id for l in with_false}, {i for i in ids if not getter[i]})
+        self.assertEqual(
+            Line.search([('id', 'in', ids), (name, '!=', True)]), with_false)
+        self.assertEqual(
+            Line.search([('id', 'in', ids), (name, '!=', False)]), with_true)
+
+    @with_transaction()
+    def test_reverse_moves(self):
+        "Test reverse moves"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([{'name': 'P1'}, {'name': 'P2'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            debit1, credit1, debit2 = create_move(accounts, [
+                    ('receivable', party1, 100, 0),
+                    ('receivable', party1, 0, 30),
+                    ('receivable', party2, 50, 0),
+                    ])
+            # Draft moves are considered
+            draft, = create_move(accounts, [('payable', party2, 0, 20)])
+            posted, = create_move(
+                accounts, [('payable', party2, 20, 0)], post=True)
+            self.assertEqual(draft.move.state, 'draft')
+
+            result = Line.get_reverse_moves(
+                [debit1, credit1, debit2, draft, posted], 'reverse_moves')
+            self.assertEqual(result, {
+                    debit1.id: True,
+                    credit1.id: True,
+                    debit2.id: False,
+                    draft.id: True,
+                    posted.id: True,
+                    })
+            # Lines of accounts neither receivable nor payable
+            revenue = [l for l in debit1.move.lines if not l.party]
+            self.assertEqual(
+                Line.get_reverse_moves(revenue, 'reverse_moves'),
+                dict.fromkeys(map(int, revenue), False))
+
+            self.assertSearchMatchesGetter(
+                'reverse_moves', [debit1, credit1, debit2, draft, posted])
+
+    @with_transaction()
+    def test_reverse_moves_without_party(self):
+        "Test reverse moves of lines without party"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party, = Party.create([{'name': 'Party'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            accounts['no_party'], = Account.copy([accounts['receivable']],
+                default={'party_required': False})
+            no_party, = create_move(accounts, [('no_party', None, 100, 0)])
+            with_party, = create_move(accounts, [('no_party', party, 0, 10)])
+
+            # Lines without party are compared with all the lines of their
+            # account but the searcher only matches lines with the same party
+            result = Line.get_reverse_moves(
+                [no_party, with_party], 'reverse_moves')
+            self.assertEqual(result, {
+                    no_party.id: True,
+                    with_party.id: False,
+                    })
+            self.assertEqual(set(Line.search([
+                        ('id', 'in', [no_party.id, with_party.id]),
+                        ('reverse_moves', '=', False),
+                        ])), {no_party, with_party})
+
+    @with_transaction()
+    def test_reverse_moves_zero_amount(self):
+        "Test reverse moves of zero amount lines"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([{'name': 'P1'}, {'name': 'P2'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            zero1, debit1 = create_move(accounts, [
+                    ('receivable', party1, 0, 0),
+                    ('receivable', party1, 100, 0),
+                    ])
+            zero2, debit2, credit2 = create_move(accounts, [
+                    ('receivable', party2, 0, 0),
+                    ('receivable', party2, 100, 0),
+                    ('receivable', party2, 0, 40),
+                    ])
+
+            # A zero amount line has reverse moves as soon as its group has
+            # unreconciled lines
+            result = Line.get_reverse_moves(
+                [zero1, debit1, zero2, debit2, credit2], 'reverse_moves')
+            self.assertEqual(result, {
+                    zero1.id: True,
+                    debit1.id: False,
+                    zero2.id: True,
+                    debit2.id: True,
+                    credit2.id: True,
+                    })
+            # But the searcher only matches the groups on debit and credit
+            self.assertEqual(Line.search([
+                        ('id', 'in', [zero1.id, zero2.id]),
+                        ('reverse_moves', '=', True),
+                        ]), [zero2])
+
+    @with_transaction()
+    def test_netting_moves(self):
+        "Test netting moves"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([{'name': 'P1'}, {'name': 'P2'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            receivable1, = create_move(
+                accounts, [('receivable', party1, 100, 0)], post=True)
+            payable1, = create_move(accounts, [('payable', party1, 0, 40)])
+            receivable2, = create_move(
+                accounts, [('receivable', party2, 100, 0)], post=True)
+            lines = [receivable1, payable1, receivable2]
+
+            # Only posted lines are netted
+            self.assertEqual(
+                Line.get_netting_moves(lines, 'netting_moves'),
+                dict.fromkeys(map(int, lines), False))
+            self.assertSearchMatchesGetter('netting_moves', lines)
+
+            Move.post([payable1.move])
+            self.assertEqual(Line.get_netting_moves(lines, 'netting_moves'), {
+                    receivable1.id: True,
+                    payable1.id: True,
+                    receivable2.id: False,
+                    })
+            self.assertSearchMatchesGetter('netting_moves', lines)
+
+            # Lines without party are not netted
+            revenue = [l for l in payable1.move.lines if not l.party]
+            self.assertEqual(
+                Line.get_netting_moves(revenue, 'netting_moves'),
+                dict.fromkeys(map(int, revenue), False))
+            self.assertSearchMatchesGetter('netting_moves', revenue)
+
+    @with_transaction()
+    def test_netting_moves_zero_amount(self):
+        "Test netting moves with zero amount lines"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party, = Party.create([{'name': 'Party'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            # Zero amount lines are neither on debit nor on credit
+            zero, receivable = create_move(accounts, [
+                    ('payable', party, 0, 0),
+                    ('receivable', party, 100, 0),
+                    ], post=True)
+            lines = [zero, receivable]
+            self.assertEqual(
+                Line.get_netting_moves(lines, 'netting_moves'),
+                dict.fromkeys(map(int, lines), False))
+            self.assertSearchMatchesGetter('netting_moves', lines)
+
+    def create_bank_account_lines(self, count):
+        '''
+        Creates count receivable lines of a party with its bank account and
+        returns the party and the bank account.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party, = Party.create([{'name': 'Party'}])
+        bank_account = create_bank_account(party)
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            payment_type = create_payment_type(company, 'receivable')
+            lines = create_move(
+                accounts, [('receivable', party, 10, 0)] * count)
+            Line.write(lines, {
+                    'payment_type': payment_type.id,
+                    'bank_account': bank_account.id,
+                    })
+        return party, bank_account
+
+    @with_transaction()
+    def test_account_bank(self):
+        "Test the account bank of invoices and lines"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party, = Party.create([{'name': 'Party'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            type_party = create_payment_type(company, 'receivable', 'party')
+            type_none = create_payment_type(company, 'receivable', 'none')
+            payment_types = [type_party, type_none, None]
+            invoices = [create_invoice(accounts, party, t)
+                for t in payment_types]
+            lines = create_move(
+                accounts, [('receivable', party, 10, 0)] * 3)
+            for line, payment_type in zip(lines, payment_types):
+                if payment_type:
+                    Line.write([line], {'payment_type': payment_type.id})
+
+            for Model, records in [(Invoice, invoices), (Line, lines)]:
+                ids = [r.id for r in records]
+                self.assertEqual(
+                    Model.get_account_bank(records, 'account_bank'),
+                    dict(zip(ids, ['party', 'none', 'none'])))
+                self.assertEqual(
+                    [r.account_bank for r in Model.browse(ids)],
+                    ['party', 'none', 'none'])
+                self.assertEqual(Model.search([
+                            ('id', 'in', ids),
+                            ('account_bank', '=', 'party'),
+                            ]), records[:1])
+                self.assertEqual(Model.search([
+                            ('id', 'in', ids),
+                            ('account_bank', '=', 'none'),
+                            ], order=[('id', 'ASC')]), records[1:])
+
+    @with_transaction()
+    def test_check_owners(self):
+        "Test removing the owner of a used bank account"
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
+
+        party, bank_account = self.create_bank_account_lines(1)
+
+        with self.assertRaises(UserError):
+            BankAccount.write([bank_account], {
+                    'owners': [('remove', [party.id])],
+                    })
+
+    @with_transaction(context={'account_bank_instrumentation': True})
+    def test_party_write_bank_accounts(self):
+        "Test writing the bank accounts of a party"
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        party, bank_account = self.create_bank_account_lines(1)
+        reset_summary()
+        self.addCleanup(reset_summary)
+
+        # Writing the same bank accounts removes no owner so nothing is
+        # checked
+        Party.write([party], {
+                'name': 'Party',
+                'bank_accounts': [('add', [bank_account.id])],
+                })
+        summary = get_summary()
+        self.assertEqual(summary['BankAccount.check_owners']['records'], 0)
+        self.assertEqual(party.bank_accounts, (bank_account,))
+
+        with self.assertRaises(UserError):
+            Party.write([party], {
+                    'bank_accounts': [('remove', [bank_account.id])],
+                    })
+
+    @with_transaction()
+    def test_check_owners_queued(self):
+        "Test the check of owners queued above the threshold"
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
+        Queue = pool.get('ir.queue')
+        Violation = pool.get('bank.account.owner.violation')
+
+        set_config(self, 'account_bank', 'check_owners_queue_threshold', '1')
+        party, bank_account = self.create_bank_account_lines(2)
+
+        BankAccount.write([bank_account], {
+                'owners': [('remove', [party.id])],
+                })
+        task, = Queue.search([])
+        self.assertEqual(task.data['model'], 'bank.account')
+        self.assertEqual(task.data['method'], 'record_owners_violations')
+        self.assertEqual(task.data['instances'], [bank_account.id])
+
+        BankAccount.record_owners_violations([bank_account])
+        violations = Violation.search([])
+        self.assertEqual(len(violations), 2)
+        self.assertEqual({v.bank_account for v in violations}, {bank_account})
+        self.assertEqual({v.party for v in violations}, {party})
+
+        # Below the threshold the check clears the fixed violations
+        set_config(self, 'account_bank', 'check_owners_queue_threshold', '2')
+        BankAccount.write([bank_account], {
+                'owners': [('add', [party.id])],
+                })
+        self.assertEqual(Violation.search([]), [])
+
+    @with_transaction()
+    def test_check_owners_below_threshold(self):
+        "Test the check of owners below the threshold"
+        pool = Pool()
+        BankAccount = pool.get('bank.account')
+        Queue = pool.get('ir.queue')
+
+        set_config(self, 'account_bank', 'check_owners_queue_threshold', '2')
+        party, bank_account = self.create_bank_account_lines(2)
+
+        with self.assertRaises(UserError):
+            BankAccount.write([bank_account], {
+                    'owners': [('remove', [party.id])],
+                    })
+        self.assertEqual(Queue.search([]), [])
+
+    @with_transaction()
+    def test_compensation_move_max_lines(self):
+        "Test compensation move split by maximum lines"
+        pool = Pool()
+        CompensationMove = pool.get(
+            'account.move.compensation_move', type='wizard')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+
+        party, = Party.create([{'name': 'Party'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            lines = create_move(accounts, [
+                    ('receivable', party, 100, 0),
+                    ('receivable', party, 0, 30),
+                    ('receivable', party, 50, 0),
+                    ('receivable', party, 0, 20),
+                    ], post=True)
+
+            session_id, _, _ = CompensationMove.create()
+            compensation_move = CompensationMove(session_id)
+            compensation_move.start.party = party
+            compensation_move.start.account = accounts['receivable']
+            compensation_move.start.date = datetime.date.today()
+            compensation_move.start.maturity_date = None
+            compensation_move.start.description = 'Compensation'
+            compensation_move.start.payment_type = None
+            compensation_move.start.bank_account = None
+            compensation_move.start.max_lines = 2
+            with Transaction().set_context(
+                    active_model=Line.__name__,
+                    active_ids=[l.id for l in lines]):
+                compensation_move.transition_create_move()
+
+            moves = Move.search([('description', '=', 'Compensation')])
+            self.assertEqual(len(moves), 2)
+            self.assertEqual({m.state for m in moves}, {'posted'})
+            self.assertTrue(all(l.reconciliation
+                    for l in Line.browse([l.id for l in lines])))
+            extra_lines = Line.search([
+                    ('move', 'in', [m.id for m in moves]),
+                    ('reconciliation', '=', None),
+                    ])
+            self.assertEqual(
+                sorted(l.debit for l in extra_lines), [Decimal(30), Decimal(70)])
+
+    @with_transaction()
+    def test_compensation_move_lines_without_party(self):
+        "Test compensation move of lines with and without party"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        Start = pool.get('account.move.compensation_move.start')
+
+        party, = Party.create([{'name': 'Party'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            accounts['no_party'], = Account.copy([accounts['receivable']],
+                default={'party_required': False})
+            lines = create_move(accounts, [
+                    ('no_party', party, 100, 0),
+                    ('no_party', None, 0, 30),
+                    ])
+
+            with Transaction().set_context(
+                    active_ids=[l.id for l in lines]):
+                with self.assertRaises(UserError):
+                    Start.default_get()
+
+    @with_transaction()
+    def test_compensate(self):
+        "Test compensate lines"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([{'name': 'P1'}, {'name': 'P2'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            receivable1, payable1 = create_move(accounts, [
+                    ('receivable', party1, 100, 0),
+                    ('payable', party1, 0, 40),
+                    ], post=True)
+            # Draft lines are not compensated
+            draft1, = create_move(accounts, [('receivable', party1, 0, 10)])
+            # Parties without lines on both sides are not compensated
+            receivable2, = create_move(
+                accounts, [('receivable', party2, 50, 0)], post=True)
+            lines = [receivable1, payable1, draft1, receivable2]
+
+            move, = Line.compensate(lines, description='Compensation')
+
+            self.assertEqual(move.state, 'posted')
+            self.assertEqual(move.description, 'Compensation')
+            lines = Line.browse([l.id for l in lines])
+            self.assertEqual(
+                [bool(l.reconciliation) for l in lines],
+                [True, True, False, False])
+            extra_line, = [l for l in move.lines if not l.reconciliation]
+            self.assertEqual(extra_line.party, party1)
+            self.assertEqual(extra_line.account, accounts['receivable'])
+            self.assertEqual(extra_line.debit, Decimal(60))
+
+    @with_transaction()
+    def test_compensation_move_batch(self):
+        "Test compensation moves of all the parties"
+        pool = Pool()
+        CompensationMoveBatch = pool.get(
+            'account.move.compensation_move.batch', type='wizard')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Queue = pool.get('ir.queue')
+
+        party1, party2, party3 = Party.create(
+            [{'name': 'P1'}, {'name': 'P2'}, {'name': 'P3'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            lines = create_move(accounts, [
+                    ('receivable', party1, 100, 0),
+                    ('payable', party1, 0, 40),
+                    ('receivable', party2, 30, 0),
+                    ('receivable', party2, 0, 50),
+                    ('receivable', party3, 20, 0),
+                    ], post=True)
+            draft, = create_move(accounts, [('receivable', party3, 0, 20)])
+
+            def execute(background):
+                session_id, _, _ = CompensationMoveBatch.create()
+                batch = CompensationMoveBatch(session_id)
+                batch.start.date = datetime.date.today()
+                batch.start.maturity_date = None
+                batch.start.description = 'Compensation'
+                batch.start.background = background
+                with Transaction().set_context(active_ids=None):
+                    batch.transition_create_moves()
+
+            execute(background=True)
+            tasks = Queue.search([])
+            self.assertEqual(len(tasks), 2)
+            self.assertEqual(
+                {t.data['method'] for t in tasks}, {'compensate'})
+            self.assertEqual(
+                sorted(sorted(t.data['instances']) for t in tasks),
+                [[l.id for l in lines[:2]], [l.id for l in lines[2:4]]])
+
+            execute(background=False)
+            moves = Move.search([('description', '=', 'Compensation')])
+            self.assertEqual(len(moves), 2)
+            self.assertEqual(
+                {l.party for m in moves for l in m.lines}, {party1, party2})
+            lines = Line.browse([l.id for l in lines + [draft]])
+            self.assertEqual(
+                [bool(l.reconciliation) for l in lines],
+                [True, True, True, True, False, False])
+
+    @with_transaction()
+    def test_open_balance(self):
+        "Test open balances are updated like a rebuild"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        OpenBalance = pool.get('account.move.line.open_balance')
+        Party = pool.get('party.party')
+        Reconciliation = pool.get('account.move.reconciliation')
+
+        def balances():
+            return {(b.company, b.account, b.party): tuple(
+                    getattr(b, f) for f in OpenBalance._balance_fields)
+                for b in OpenBalance.search([('line_count', '!=', 0)])}
+
+        def assertBalances():
+            updated = balances()
+            OpenBalance.rebuild()
+            self.assertEqual(updated, balances())
+
+        party1, party2 = Party.create([{'name': 'P1'}, {'name': 'P2'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            debit, credit = create_move(accounts, [
+                    ('receivable', party1, 100, 0),
+                    ('receivable', party1, 0, 100),
+                    ])
+            other, = create_move(accounts, [('payable', party2, 0, 50)])
+            assertBalances()
+
+            Move.post([debit.move])
+            assertBalances()
+
+            Line.reconcile([debit, credit])
+            assertBalances()
+
+            Reconciliation.delete(Reconciliation.search([]))
+            assertBalances()
+
+            Line.write([other], {'party': party1.id})
+            assertBalances()
+
+            draft, = create_move(accounts, [('receivable', party2, 10, 0)])
+            Line.delete(draft.move.lines)
+            assertBalances()
+
+            # The rebuild deletes the balances without lines
+            self.assertTrue(OpenBalance.search([('line_count', '=', 0)]))
+            OpenBalance.rebuild()
+            self.assertEqual(OpenBalance.search([('line_count', '=', 0)]), [])
+
+    @with_transaction()
+    def test_open_balance_move_write(self):
+        "Test open balances when writing a move and its lines at once"
+        pool = Pool()
+        Move = pool.get('account.move')
+        OpenBalance = pool.get('account.move.line.open_balance')
+        Party = pool.get('party.party')
+        Reconciliation = pool.get('account.move.reconciliation')
+
+        party, = Party.create([{'name': 'Party'}])
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            debit, credit, _ = create_move(accounts, [
+                    ('receivable', party, 100, 0),
+                    ('receivable', party, 0, 100),
+                    ('payable', party, 0, 40),
+                    ])
+            reconciliation, = Reconciliation.create([{
+                        'number': 'Reconciliation',
+                        'company': company.id,
+                        'date': datetime.date.today(),
+                        }])
+
+            # The lines are removed once with the state of the move before
+            # the write and added once with the state after
+            Move.write([debit.move], {
+                    'state': 'posted',
+                    'lines': [('write', [debit.id, credit.id], {
+                                'reconciliation': reconciliation.id,
+                                })],
+                    })
+
+            balance, = OpenBalance.search([
+                    ('account', '=', accounts['receivable'].id),
+                    ('party', '=', party.id),
+                    ])
+            self.assertEqual(
+                [getattr(balance, f) for f in OpenBalance._balance_fields],
+                [0, 0, 0, 0, 0, Decimal(0), Decimal(0)])
+            balance, = OpenBalance.search([
+                    ('account', '=', accounts['payable'].id),
+                    ('party', '=', party.id),
+                    ])
+            self.assertEqual(
+                [getattr(balance, f) for f in OpenBalance._balance_fields],
+                [1, 0, 1, 0, 1, Decimal(0), Decimal(40)])
+
+    @with_transaction()
+    def test_account_bank_from_cache(self):
+        "Test the account bank from cache follows the payment types"
+        pool = Pool()
+        Party = pool.get('party.party')
+        PaymentType = pool.get('account.payment.type')
+
+        party, other1, other2 = Party.create(
+            [{'name': 'Party'}, {'name': 'Other 1'}, {'name': 'Other 2'}])
+        account1 = create_bank_account(other1)
+        account2 = create_bank_account(other2)
+        company = create_company()
+        with set_company(company):
+            payment_type = create_payment_type(company, 'receivable')
+
+            def account_bank_from():
+                return PaymentType.get_account_bank_from(
+                    payment_type.id, party.id, company.id)
+
+            self.assertEqual(account_bank_from(), party.id)
+            PaymentType.write([payment_type], {'account_bank': 'company'})
+            self.assertEqual(account_bank_from(), company.party.id)
+            PaymentType.write([payment_type], {
+                    'account_bank': 'other',
+                    'party': other1.id,
+                    'bank_account': account1.id,
+                    })
+            self.assertEqual(account_bank_from(), other1.id)
+            PaymentType.write([payment_type], {
+                    'party': other2.id,
+                    'bank_account': account2.id,
+                    })
+            self.assertEqual(account_bank_from(), other2.id)
+
+    @with_transaction()
+    def test_get_bank_accounts(self):
+        "Test resolving bank accounts in bulk like one by one"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        PaymentType = pool.get('account.payment.type')
+
+        party1, party2, other = Party.create(
+            [{'name': 'P1'}, {'name': 'P2'}, {'name': 'Other'}])
+        party_account = create_bank_account(party1)
+        other_account = create_bank_account(other)
+        company = create_company()
+        company_account = create_bank_account(company.party)
+        default_company_account = create_bank_account(company.party)
+        with set_company(company):
+            Party.write([party1], {
+                    'receivable_bank_account': party_account.id,
+                    'receivable_company_bank_account': company_account.id,
+                    }, [company.party], {
+                    'receivable_bank_account': default_company_account.id,
+                    })
+            payment_types = [
+                create_payment_type(company, 'receivable', account_bank)
+                for account_bank in ['none', 'party', 'company', 'other']]
+            PaymentType.write([payment_types[-1]], {
+                    'party': other.id,
+                    'bank_account': other_account.id,
+                    })
+
+            def invoices():
+                for payment_type in payment_types + [None]:
+                    for party in [party1, party2, None]:
+                        for bank_account in [None, default_company_account]:
+                            yield Invoice(
+                                company=company,
+                                party=party,
+                                payment_type=payment_type,
+                                bank_account=bank_account)
+
+            expected = []
+            for invoice in invoices():
+                invoice._get_bank_account()
+                expected.append(invoice.bank_account)
+            records = list(invoices())
+            Invoice._get_bank_accounts(records)
+
+            self.assertEqual([r.bank_account for r in records], expected)
+            self.assertIn(company_account, expected)
+            self.assertIn(default_company_account, expected)
+            self.assertIn(other_account, expected)
+
+    @with_transaction()
+    def test_invoice_on_change_bank_account(self):
+        "Test the bank account of invoices in the client"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([{
+                    'name': name,
+                    'addresses': [('create', [{}])],
+                    } for name in ['P1', 'P2']])
+        default1 = create_bank_account(party1)
+        chosen1 = create_bank_account(party1)
+        default2 = create_bank_account(party2)
+        company = create_company()
+        with set_company(company):
+            create_accounts(company)
+            payment_type = create_payment_type(company, 'receivable')
+            type_none = create_payment_type(company, 'receivable', 'none')
+            Party.write([party1], {
+                    'receivable_bank_account': default1.id,
+                    'customer_payment_type': payment_type.id,
+                    }, [party2], {
+                    'receivable_bank_account': default2.id,
+                    'customer_payment_type': payment_type.id,
+                    })
+
+            invoice = Invoice(
+                type='out', company=company, currency=company.currency,
+                party=party1, payment_type=payment_type, bank_account=None,
+                invoice_date=None, accounting_date=None, lines=[], taxes=[])
+            invoice.on_change_payment_type()
+            self.assertEqual(invoice.bank_account, default1)
+
+            # The bank account chosen by the user is kept when editing lines
+            invoice.bank_account = chosen1
+            invoice.on_change_lines()
+            self.assertEqual(invoice.bank_account, chosen1)
+            invoice.lines = [
+                InvoiceLine(type='comment', description='Comment')]
+            invoice.on_change_lines()
+            self.assertEqual(invoice.bank_account, chosen1)
+
+            # but it is recomputed when the party or payment type changes
+            invoice.party = party2
+            invoice.on_change_party()
+            self.assertEqual(invoice.bank_account, default2)
+            invoice.on_change_lines()
+            self.assertEqual(invoice.bank_account, default2)
+
+            invoice.payment_type = type_none
+            invoice.on_change_payment_type()
+            self.assertEqual(invoice.bank_account, None)
+            invoice.on_change_lines()
+            self.assertEqual(invoice.bank_account, None)
+
+            invoice.payment_type = payment_type
+            invoice.on_change_payment_type()
+            self.assertEqual(invoice.bank_account, default2)
+
+    @with_transaction()
+    def test_invoice_post_bank_accounts(self):
+        "Test posting invoices checks and writes their bank accounts"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+
+        party1, party2, party3 = Party.create(
+            [{'name': 'P1'}, {'name': 'P2'}, {'name': 'P3'}])
+        bank_account1 = create_bank_account(party1)
+        bank_account2 = create_bank_account(party2)
+        company = create_company()
+        with set_company(company):
+            Party.write([party1], {
+                    'receivable_bank_account': bank_account1.id,
+                    })
+            accounts = create_accounts(company)
+            payment_type = create_payment_type(company, 'receivable')
+            invoice1 = create_invoice(accounts, party1, payment_type)
+            invoice2 = create_invoice(
+                accounts, party2, payment_type, bank_account=bank_account2)
+            missing = [create_invoice(accounts, party3, payment_type)
+                for _ in range(2)]
+
+            # A single error lists all the invoices without bank account
+            with self.assertRaises(UserError) as cm:
+                Invoice.post([invoice1, invoice2] + missing)
+            for invoice in missing:
+                self.assertIn(invoice.rec_name, cm.exception.message)
+            invoice1, invoice2 = Invoice.browse([invoice1.id, invoice2.id])
+            self.assertEqual(invoice1.state, 'draft')
+            self.assertEqual(invoice1.bank_account, None)
+
+            Invoice.post([invoice1, invoice2])
+            invoice1, invoice2 = Invoice.browse([invoice1.id, invoice2.id])
+            self.assertEqual(invoice1.state, 'posted')
+            self.assertEqual(invoice1.bank_account, bank_account1)
+            self.assertEqual(invoice2.state, 'posted')
+            self.assertEqual(invoice2.bank_account, bank_account2)
+
+    @with_transaction()
+    def test_invoice_post_move_lines_bank_account(self):
+        "Test posting invoices sets their bank account on the move lines"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([{'name': 'P1'}, {'name': 'P2'}])
+        bank_account1 = create_bank_account(party1)
+        bank_account2 = create_bank_account(party2)
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            payment_type = create_payment_type(company, 'receivable')
+            invoices = [
+                create_invoice(accounts, party1, payment_type,
+                    bank_account=bank_account1),
+                create_invoice(accounts, party2, payment_type,
+                    bank_account=bank_account2),
+                create_invoice(accounts, party2, payment_type,
+                    bank_account=bank_account2),
+                ]
+
+            Invoice.post(invoices)
+
+            for invoice in Invoice.browse([i.id for i in invoices]):
+                self.assertEqual(invoice.move.state, 'posted')
+                for line in invoice.move.lines:
+                    if line.account == invoice.account:
+                        self.assertEqual(
+                            line.bank_account, invoice.bank_account)
+                    else:
+                        self.assertEqual(line.bank_account, None)
+
+    @with_transaction()
+    def test_pay_line_payment_type(self):
+        "Test paying lines fills the bank account from the payment type"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Party = pool.get('party.party')
+        PayLine = pool.get('account.move.line.pay', type='wizard')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+
+        party, = Party.create([{'name': 'Party'}])
+        bank_account = create_bank_account(party)
+        company = create_company()
+        with set_company(company):
+            Party.write([party], {
+                    'receivable_bank_account': bank_account.id,
+                    })
+            accounts = create_accounts(company)
+            journal_none, journal_party = PaymentJournal.create([{
+                        'name': 'None',
+                        'process_method': 'manual',
+                        'currency': company.currency.id,
+                        'company': company.id,
+                        'payment_type': create_payment_type(
+                            company, 'receivable', 'none').id,
+                        }, {
+                        'name': 'Party',
+                        'process_method': 'manual',
+                        'currency': company.currency.id,
+                        'company': company.id,
+                        'payment_type': create_payment_type(
+                            company, 'receivable', 'party').id,
+                        }])
+            line1, line2 = create_move(accounts, [
+                    ('receivable', party, 100, 0),
+                    ('receivable', party, 50, 0),
+                    ], post=True)
+            Line.write([line1, line2], {
+                    'maturity_date': datetime.date.today(),
+                    })
+
+            for line, journal in [
+                    (line1, journal_none), (line2, journal_party)]:
+                context = {
+                    'active_model': Line.__name__,
+                    'active_ids': [line.id],
+                    'active_id': line.id,
+                    }
+                with Transaction().set_context(**context):
+                    session_id, _, _ = PayLine.create()
+                    pay_line = PayLine(session_id)
+                    pay_line.start.date = None
+                    pay_line.ask_journal.journal = journal
+                    pay_line.ask_journal.journals = [journal]
+                    pay_line.do_pay(None)
+
+            payment1, = Payment.search([('line', '=', line1.id)])
+            self.assertEqual(payment1.bank_account, None)
+            payment2, = Payment.search([('line', '=', line2.id)])
+            self.assertEqual(payment2.bank_account, bank_account)
+
+    @with_transaction()
+    def test_pay_line_invoice_bank_account(self):
+        "Test paying lines takes the bank account of their invoice"
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        PayLine = pool.get('account.move.line.pay', type='wizard')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+
+        party, = Party.create([{
+                    'name': 'Party',
+                    'addresses': [('create', [{}])],
+                    }])
+        line_account = create_bank_account(party)
+        invoice_account = create_bank_account(party)
+        company = create_company()
+        with set_company(company):
+            accounts = create_accounts(company)
+            payment_type = create_payment_type(company, 'receivable')
+            journal, = PaymentJournal.create([{
+                        'name': 'Party',
+                        'process_method': 'manual',
+                        'currency': company.currency.id,
+                        'company': company.id,
+                        'payment_type': payment_type.id,
+                        }])
+            invoice = create_invoice(accounts, party, payment_type,
+                bank_account=invoice_account)
+            line1, line2, line3 = create_move(accounts, [
+                    ('receivable', party, 100, 0),
+                    ('receivable', party, 50, 0),
+                    ('receivable', party, 20, 0),
+                    ])
+            Line.write([line1], {
+                    'payment_type': payment_type.id,
+                    'bank_account': line_account.id,
+                    'origin': str(invoice),
+                    }, [line2], {
+                    'origin': str(invoice),
+                    })
+            Move.post([line1.move])
+            lines = [line1, line2, line3]
+            Line.write(lines, {
+                    'maturity_date': datetime.date.today(),
+                    })
+
+            context = {
+                'active_model': Line.__name__,
+                'active_ids': [l.id for l in lines],
+                'active_id': line1.id,
+                }
+            with Transaction().set_context(**context):
+                session_id, _, _ = PayLine.create()
+                pay_line = PayLine(session_id)
+                pay_line.start.date = None
+                pay_line.ask_journal.journal = journal
+                pay_line.ask_journal.journals = [journal]
+                pay_line.do_pay(None)
+
+            self.assertEqual([
+                    Payment.search([('line', '=', l.id)])[0].bank_account
+                    for l in lines],
+                [line_account, invoice_account, None])
+
+    @with_transaction()
+    def test_payment_default_bank_account(self):
+        "Test the default bank account of payments"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        PaymentType = pool.get('account.payment.type')
+
+        party, other = Party.create([{'name': 'Party'}, {'name': 'Other'}])
+        party_account = create_bank_account(party)
+        other_account = create_bank_account(other)
+        company = create_company()
+        company_account = create_bank_account(company.party)
+        default_company_account = create_bank_account(company.party)
+        with set_company(company):
+            Party.write([party], {
+                    'payable_bank_account': party_account.id,
+                    'payable_company_bank_account': company_account.id,
+                    }, [company.party], {
+                    'payable_bank_account': default_company_account.id,
+                    })
+            journals = {}
+            for account_bank in ['none', 'party', 'company', 'other']:
+                payment_type = create_payment_type(
+                    company, 'payable', account_bank)
+                if account_bank == 'other':
+                    PaymentType.write([payment_type], {
+                            'party': other.id,
+                            'bank_account': other_account.id,
+                            })
+                journals[account_bank], = PaymentJournal.create([{
+                            'name': account_bank,
+                            'process_method': 'manual',
+                            'currency': company.currency.id,
+                            'company': company.id,
+                            'payment_type': payment_type.id,
+                            }])
+
+            def values(account_bank, party):
+                return {
+                    'journal': journals[account_bank].id,
+                    'kind': 'payable',
+                    'party': party.id,
+                    'amount': Decimal(10),
+                    'date': datetime.date.today(),
+                    }
+
+            payments = Payment.create([
+                    values('none', party),
+                    values('party', party),
+                    values('company', party),
+                    values('company', other),
+                    values('other', party),
+                    ])
+            self.assertEqual([p.bank_account for p in payments], [
+                    None,
+                    party_account,
+                    company_account,
+                    default_company_account,
+                    other_account,
+                    ])
+
+            # The client gets the same bank accounts
+            for payment, on_change in zip(payments, [
+                        'on_change_party', 'on_change_kind',
+                        'on_change_line', 'on_change_party',
+                        'on_change_kind']):
+                new = Payment()
+                new.company = company
+                new.journal = payment.journal
+                new.kind = payment.kind
+                new.party = payment.party
+                new.line = None
+                getattr(new, on_change)()
+                self.assertEqual(new.bank_account, payment.bank_account)
+
+    @with_transaction()
+    def test_group_journal_fields(self):
+        "Test the payment type and currency of payment groups"
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        PaymentJournal = pool.get('account.payment.journal')
+
+        company = create_company()
+        currency = create_currency('USD')
+        with set_company(company):
+            receivable = create_payment_type(company, 'receivable')
+            payable = create_payment_type(company, 'payable')
+            journal1, journal2 = PaymentJournal.create([{
+                        'name': 'Receivable',
+                        'process_method': 'manual',
+                        'currency': company.currency.id,
+                        'company': company.id,
+                        'payment_type': receivable.id,
+                        }, {
+                        'name': 'Payable',
+                        'process_method': 'manual',
+                        'currency': currency.id,
+                        'company': company.id,
+                        'payment_type': payable.id,
+                        }])
+            group1, group2 = Group.create([{
+                        'number': str(i),
+                        'company': company.id,
+                        'journal': journal.id,
+                        'kind': kind,
+                        } for i, (journal, kind) in enumerate(
+                        [(journal1, 'receivable'), (journal2, 'payable')])])
+
+            self.assertEqual(
+                Group.get_journal_fields(
+                    [group1, group2], ['payment_type', 'currency']), {
+                    'payment_type': {
+                        group1.id: receivable.id,
+                        group2.id: payable.id,
+                        },
+                    'currency': {
+                        group1.id: company.currency.id,
+                        group2.id: currency.id,
+                        },
+                    })
+            group1, group2 = Group.browse([group1.id, group2.id])
+            self.assertEqual(
+                [(g.payment_type, g.currency) for g in [group1, group2]],
+                [(receivable, company.currency), (payable, currency)])
+
+            for clause, groups in [
+                    (('payment_type', '=', receivable.id), [group1]),
+                    (('payment_type', '=', payable.id), [group2]),
+                    (('payment_type.kind', '=', 'payable'), [group2]),
+                    (('currency', '=', currency.id), [group2]),
+                    (('currency', '!=', currency.id), [group1]),
+                    ]:
+                self.assertEqual(Group.search([clause]), groups)
+
+    @with_transaction()
+    def test_get_sepa_mandates(self):
+        "Test the SEPA mandates of the payments"
+        pool = Pool()
+        Bank = pool.get('bank')
+        BankAccount = pool.get('bank.account')
+        Mandate = pool.get('account.payment.sepa.mandate')
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+
+        party, other1, other2 = Party.create([{
+                    'name': name,
+                    'addresses': [('create', [{}])],
+                    } for name in ['Party', 'Other 1', 'Other 2']])
+        bank_party, = Party.create([{'name': 'Bank'}])
+        bank, = Bank.create([{'party': bank_party.id}])
+        account1, account2 = BankAccount.create([{
+                    'bank': bank.id,
+                    'numbers': [('create', [{
+                                    'type': 'iban',
+                                    'number': number,
+                                    }])],
+                    'owners': [('add', [party.id])],
+                    } for number in [
+                    'ES3600000000050000000001', 'ES6300000000010000000002']])
+        company = create_company()
+        with set_company(company):
+            mandate1, mandate2 = Mandate.create([{
+                        'company': company.id,
+                        'party': party.id,
+                        'address': party.addresses[0].id,
+                        'account_number': account.numbers[0].id,
+                        'identification': 'MANDATE%s' % i,
+                        'type': 'recurrent',
+                        'signature_date': datetime.date.today(),
+                        'state': 'validated',
+                        } for i, account in enumerate(
+                        [account1, account2])])
+            journal, = PaymentJournal.create([{
+                        'name': 'Manual',
+                        'process_method': 'manual',
+                        'currency': company.currency.id,
+                        'company': company.id,
+                        'payment_type': create_payment_type(
+                            company, 'receivable', 'none').id,
+                        }])
+
+            def values(party, bank_account=None):
+                return {
+                    'journal': journal.id,
+                    'kind': 'receivable',
+                    'party': party.id,
+                    'bank_account': bank_account.id if bank_account else None,
+                    'amount': Decimal(10),
+                    'date': datetime.date.today(),
+                    }
+
+            payment1, payment2, payment3 = Payment.create([
+                    values(party, account1),
+                    values(party, account2),
+                    values(party),
+                    ])
+            # The mandate of the bank account of the payment is used instead
+            # of the first valid mandate of the party
+            self.assertEqual(
+                Payment.get_sepa_mandates([payment1, payment2, payment3]),
+                [mandate1, mandate2, None])
+
+            missing = Payment.create([values(other1), values(other2)])
+            with self.assertRaises(UserError) as cm:
+                Payment.get_sepa_mandates([payment1] + missing)
+            for payment in missing:
+                self.assertIn('%s (%s)' % (
+                        payment.rec_name, payment.party.rec_name),
+                    cm.exception.message)
+
+    @with_transaction(context={'account_bank_instrumentation': True})
+    def test_instrumentation(self):
+        "Test the instrumentation summary"
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        party1, party2, party3 = Party.create(
+            [{'name': 'P1'}, {'name': 'P2'}, {'name': 'P3'}])
+        reset_summary()
+        self.addCleanup(reset_summary)
+
+        Party.write([party1], {'name': 'A'}, [party2, party3], {'name': 'B'})
+
+        summary = get_summary()
+        self.assertEqual(summary['Party.write']['calls'], 1)
+        self.assertEqual(summary['Party.write']['records'], 3)
+        self.assertGreaterEqual(summary['Party.write']['seconds'], 0)
+        self.assertGreaterEqual(summary['Party.write']['rows'], 0)
+
+        reset_summary()
+        self.assertEqual(get_summary(), {})
 
 
 del ModuleTestCase
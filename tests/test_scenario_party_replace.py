@@ -120,3 +120,31 @@ class Test(unittest.TestCase):
         # Check fields have been replaced
         payment_type.reload()
         self.assertEqual(payment_type.party, party2)
+
+        # Check bank account owners have been replaced
+        bank_account.reload()
+        self.assertEqual(
+            [o.id for o in bank_account.owners], [party2.id])
+
+        # Replace a party by a party that already owns its bank account
+        party3 = Party(name='Party 3')
+        party3.save()
+        party4 = Party(name='Party 4')
+        party4.save()
+        bank_account2 = BankAccount()
+        bank_account2.bank = bank
+        bank_number = bank_account2.numbers.new()
+        bank_number.type = 'other'
+        bank_number.number = 'shared'
+        bank_account2.owners.append(Party(party3.id))
+        bank_account2.owners.append(Party(party4.id))
+        bank_account2.save()
+
+        replace = Wizard('party.replace', models=[party3])
+        replace.form.source = party3
+        replace.form.destination = party4
+        replace.execute('replace')
+
+        bank_account2.reload()
+        self.assertEqual(
+            [o.id for o in bank_account2.owners], [party4.id])